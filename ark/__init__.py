@@ -11,9 +11,9 @@
 import sys
 
 
-# Ark requires at least Python 3.2.
-if sys.version_info < (3, 2):
-    sys.exit('Error: Ark requires Python >= 3.2.')
+# Ark requires at least Python 3.5.
+if sys.version_info < (3, 5):
+    sys.exit('Error: Ark requires Python >= 3.5.')
 
 
 # Template for error messages informing the user of any missing libraries.
@@ -84,4 +84,10 @@ from . import meta
 from . import templates
 from . import renderers
 from . import hashes
+from . import deps
+from . import output
+from . import resources
+from . import writer
+from . import archives
+from . import stats
 from . import extensions
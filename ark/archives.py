@@ -0,0 +1,132 @@
+# --------------------------------------------------------------------------
+# Archive output backends.
+#
+# Instead of writing the site to its output directory the build can stream
+# its output files straight into an archive. The archive format is chosen
+# by the archive's file extension:
+#
+#   * .tar, .tar.gz, .tgz
+#   * .tar.zst, .tzst (requires the zstandard library)
+#   * .zip
+#
+# An archive path of '-' writes an uncompressed tar stream to stdout.
+#
+# Archives are reproducible: files copied from disk keep their source file's
+# modification time and generated files are stamped with the time given by
+# the SOURCE_DATE_EPOCH environment variable or, if it isn't set, a fixed
+# time of 1980-01-01 00:00 UTC.
+# --------------------------------------------------------------------------
+
+import io
+import os
+import sys
+import time
+import gzip
+import tarfile
+import zipfile
+
+
+# The zstandard library is optional.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The earliest time a zip archive can store, 1980-01-01 00:00 UTC.
+ZIP_EPOCH = 315532800
+
+
+# Returns the modification time given to generated files.
+def timestamp():
+    return int(os.environ.get('SOURCE_DATE_EPOCH', ZIP_EPOCH))
+
+
+# Returns an archive instance for the specified path.
+def open(path):
+    if path == '-' or path.endswith(('.tar', '.tar.gz', '.tgz')):
+        return TarArchive(path)
+    if path.endswith(('.tar.zst', '.tzst')):
+        if zstandard is None:
+            sys.exit("Error: .tar.zst archives require the zstandard library.")
+        return TarArchive(path)
+    if path.endswith('.zip'):
+        return ZipArchive(path)
+    sys.exit("Error: unrecognised archive format '%s'." % path)
+
+
+class TarArchive:
+
+    """ Writes output files into a tar archive. """
+
+    def __init__(self, path):
+        self.file = self.stream = None
+
+        if path == '-':
+            # Anything printed by the application would corrupt the stream
+            # so we redirect printed output to stderr.
+            self.tar = tarfile.open(fileobj=sys.__stdout__.buffer, mode='w|')
+            sys.stdout = sys.stderr
+        elif path.endswith(('.tar.zst', '.tzst')):
+            self.file = io.open(path, 'wb')
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.file)
+            self.tar = tarfile.open(fileobj=self.stream, mode='w|')
+        elif path.endswith('.tar'):
+            self.tar = tarfile.open(path, mode='w')
+        else:
+            # The gzip header carries a timestamp too.
+            self.file = io.open(path, 'wb')
+            self.stream = gzip.GzipFile(
+                fileobj=self.file, mode='wb', mtime=timestamp()
+            )
+            self.tar = tarfile.open(fileobj=self.stream, mode='w')
+
+    # Adds a file to the archive with the specified content.
+    def add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = timestamp()
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+
+    # Adds a file on disk to the archive. The file keeps its modification
+    # time but not its owner.
+    def addfile(self, name, path):
+        info = self.tar.gettarinfo(path, arcname=name)
+        info.mtime = int(info.mtime)
+        info.mode = 0o644
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        with io.open(path, 'rb') as file:
+            self.tar.addfile(info, file)
+
+    def close(self):
+        self.tar.close()
+        if self.stream:
+            self.stream.close()
+        if self.file and not self.file.closed:
+            self.file.close()
+
+
+class ZipArchive:
+
+    """ Writes output files into a zip archive. """
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+    # Adds a file to the archive with the specified content.
+    def add(self, name, data):
+        date = time.gmtime(max(timestamp(), ZIP_EPOCH))[:6]
+        info = zipfile.ZipInfo(name, date)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        self.zip.writestr(info, data)
+
+    # Adds a file on disk to the archive. The file keeps its modification
+    # time.
+    def addfile(self, name, path):
+        self.zip.write(path, arcname=name)
+
+    def close(self):
+        self.zip.close()
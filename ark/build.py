@@ -3,19 +3,33 @@
 # --------------------------------------------------------------------------
 
 import os
+import sys
+import time
+import heapq
+import collections
+import multiprocessing
 
 from . import site
 from . import utils
 from . import pages
 from . import records
 from . import hooks
+from . import stats
+from . import resources
+from . import writer
+
+
+# A SrcDir instance represents a directory of record files. It lists the
+# directory's record files and its subdirectories as SrcDir instances.
+SrcDir = collections.namedtuple('SrcDir', 'path, name, files, subdirs')
 
 
 # Builds the site.
 #
 #   1. Copies the site and theme resource files to the output directory.
-#   2. Builds the individual record pages.
-#   3. Builds the directory index pages.
+#   2. Scans the site's [type] directories for record files.
+#   3. Builds the individual record pages, optionally in parallel.
+#   4. Builds the directory index pages.
 #
 def build_site():
 
@@ -23,68 +37,206 @@ def build_site():
     hooks.event('init_build')
 
     # Copy the site's resource files to the output directory, i.e. any files
-    # in the site's src directory not inside a [type] directory.
-    utils.copydir(site.src(), site.out(), skiptypes=True)
-
-    # Copy the theme's resource files to the output directory.
-    if os.path.exists(site.theme('resources')):
-        utils.copydir(site.theme('resources'), site.out(), onlyolder=False)
+    # in the site's src directory not inside a [type] directory, and the
+    # theme's resource files. Theme files take precedence.
+    with stats.timed('copy_resources'):
+        resources.sync([
+            (site.src(), True),
+            (site.theme('resources'), False),
+        ], site.out())
+
+    # Scan the site's [type] directories. Each directory tree is walked
+    # once and feeds both the record pages and the directory indexes.
+    typedirs = []
+    for dirinfo in utils.subdirs(site.src()):
+        if dirinfo.name.startswith('['):
+            typedirs.append(scan(dirinfo.path))
+
+    # Build the individual record pages, in parallel if requested.
+    if site.jobs() > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        build_record_pages_parallel(typedirs, site.jobs())
+    else:
+        for srcdir in typedirs:
+            build_record_pages(srcdir)
 
-    # Build the individual record pages and directory indexes.
-    for path, name in utils.subdirs(site.src()):
-        if name.startswith('['):
-            build_record_pages(path)
-            if site.typeconfig(name.strip('[]'), 'indexed'):
-                build_directory_indexes(path)
+    # Build the directory indexes.
+    with stats.timed('dir_indexes'):
+        for srcdir in typedirs:
+            if site.typeconfig(srcdir.name.strip('[]'), 'indexed'):
+                build_directory_indexes(srcdir)
 
     # Fire the 'exit_build' event.
     hooks.event('exit_build')
 
 
-# Creates a HTML page for each record file in the source directory.
-def build_record_pages(dirpath):
+# Rebuilds the site in a long-running process, e.g. when watching the site
+# for changes. The site's counters and timers are reset; modules which cache
+# state between builds reset their own state on the 'init_build' event.
+def rebuild():
+    site.setconfig('[start]', time.time())
+    site.setconfig('[rendered]', 0)
+    site.setconfig('[written]', 0)
+    site.setconfig('[timers]', {})
+    build_site()
+
+
+# Returns a SrcDir instance for the specified directory, scanning its
+# subdirectories recursively. Files and directories are listed in a single
+# pass using the file type information returned by os.scandir().
+def scan(dirpath):
+    files, subdirs = [], []
+    for entry in os.scandir(dirpath):
+        if entry.is_dir():
+            subdirs.append(scan(entry.path))
+        elif entry.is_file() and entry.name[0] not in ('.', '_'):
+            files.append(entry.path)
+    return SrcDir(dirpath, os.path.basename(dirpath), files, subdirs)
 
-    for fileinfo in utils.srcfiles(dirpath):
-        record = records.record(fileinfo.path)
-        page = pages.RecordPage(record)
-        page.render()
 
-    for dirinfo in utils.subdirs(dirpath):
-        build_record_pages(dirinfo.path)
+# Creates a HTML page for each record file in the source directory. Record
+# files are loaded in chunks so records with the same file extension can be
+# rendered in batches. (The chunk size can be set via a 'render_batch'
+# variable in the site's config file.)
+def build_record_pages(srcdir):
 
+    size = site.config('render_batch', 64)
+    for i in range(0, len(srcdir.files), size):
+        for record in records.record_many(srcdir.files[i:i + size]):
+            page = pages.RecordPage(record)
+            page.render()
 
-# Creates a paged index for each directory of records.
-def build_directory_indexes(dirpath, recursing=False):
+    for subdir in srcdir.subdirs:
+        build_record_pages(subdir)
+
+
+# Creates record pages using a pool of worker processes.
+#
+# Workers are forked from the parent process so they inherit its fully
+# initialized state, i.e. the site configuration, loaded extensions, and
+# registered hooks. Each worker parses and renders a batch of records, then
+# returns the records to the parent along with any state accumulated by hook
+# handlers during the batch, e.g. tag registrations and page hashes.
+# Batches are merged in order so the result is identical to a serial build.
+def build_record_pages_parallel(srcdirs, jobs):
+
+    # Assemble a list of record files in serial build order.
+    filepaths = []
+    for srcdir in srcdirs:
+        filepaths.extend(find_record_files(srcdir))
+
+    # Split the list into batches, aiming for a few batches per worker.
+    size = site.config('render_batch', 64)
+    size = max(1, min(size, len(filepaths) // (jobs * 4)))
+    batches = [filepaths[i:i + size] for i in range(0, len(filepaths), size)]
+
+    # Finish any queued writes and stop the writer threads before forking.
+    # A thread holding a lock at the moment of the fork would leave the
+    # lock held forever in the worker processes.
+    with stats.timed('writing'):
+        writer.flush()
+    writer.reset()
+
+    context = multiprocessing.get_context('fork')
+    with context.Pool(jobs, initializer=init_worker) as pool:
+        for reclist, state in pool.imap(build_record_batch, batches):
+            if 'exit' in state:
+                pool.terminate()
+                sys.exit(state['exit'])
+            for record in reclist:
+                records.add(record)
+            site.rendered(state['rendered'])
+            site.written(state['written'])
+            for name, seconds in state['timers'].items():
+                site.timer(name, seconds)
+            hooks.event('merge_worker_state', state)
+
+
+# Returns a list of the record files in a directory and its subdirectories.
+def find_record_files(srcdir):
+    filepaths = srcdir.files[:]
+    for subdir in srcdir.subdirs:
+        filepaths.extend(find_record_files(subdir))
+    return filepaths
+
+
+# Initializes a newly forked worker process.
+def init_worker():
+
+    # Fire the 'init_worker' event. Handlers should discard any state copied
+    # from the parent process which will be merged back in later.
+    hooks.event('init_worker')
+
+
+# Parses and renders a batch of records inside a worker process. Returns
+# the list of records and a dictionary of state to merge into the parent.
+def build_record_batch(filepaths):
+    rendered, written = site.rendered(), site.written()
+    timers = dict(site.config('[timers]', {}))
+
+    # A call to sys.exit() would kill the worker and leave the pool waiting
+    # forever for its result so we hand the exit status to the parent.
+    try:
+        reclist = records.record_many(filepaths)
+        for record in reclist:
+            page = pages.RecordPage(record)
+            page.render()
+        with stats.timed('writing'):
+            writer.flush()
+    except SystemExit as e:
+        return [], {'exit': e.code}
+
+    state = {
+        'rendered': site.rendered() - rendered,
+        'written': site.written() - written,
+        'timers': {
+            name: seconds - timers.get(name, 0.0)
+            for name, seconds in site.config('[timers]', {}).items()
+        },
+    }
+
+    # Filter the state dictionary on the 'worker_state' filter hook. Handlers
+    # should add any state they've accumulated during the batch and reset it.
+    return reclist, hooks.filter('worker_state', state)
+
+
+# Creates a paged index for each directory of records. Returns the sorted
+# list of records in the directory and its subdirectories.
+def build_directory_indexes(srcdir, recursing=False):
 
     # Determine the record type from the directory path.
-    rectype = site.type_from_src(dirpath)
+    rectype = site.type_from_src(srcdir.path)
 
     # Fetch the type's configuration data.
     typeconfig = site.typeconfig(rectype)
+    order_by, reverse = typeconfig['order_by'], typeconfig['reverse']
+    key = lambda rec: rec[order_by]
 
-    # Assemble a list of records in this directory and any subdirectories.
+    # Assemble a sorted list of the records in this directory.
     reclist = []
-
-    # Process subdirectories first.
-    for dirinfo in utils.subdirs(dirpath):
-        reclist.extend(build_directory_indexes(dirinfo.path, True))
-
-    # Add any records in this directory to the index.
-    for fileinfo in utils.srcfiles(dirpath):
-        record = records.record(fileinfo.path)
-        if typeconfig['order_by'] in record:
+    for filepath in srcdir.files:
+        record = records.record(filepath)
+        if order_by in record:
             reclist.append(record)
+    reclist.sort(key=key, reverse=reverse)
+
+    # Merge in the sorted lists from any subdirectories. The merge is stable
+    # so records with equal keys keep their directory order.
+    sublists = [build_directory_indexes(d, True) for d in srcdir.subdirs]
+    if sublists:
+        sublists.append(reclist)
+        reclist = list(heapq.merge(*sublists, key=key, reverse=reverse))
 
     # Are we displaying this index on the homepage?
     if typeconfig['homepage'] and not recursing:
         slugs = []
     else:
-        slugs = site.slugs_from_src(dirpath)
+        slugs = site.slugs_from_src(srcdir.path)
 
-    # Create and render the set of index pages.
+    # Create and render the set of index pages. The Index sorts the list in
+    # place but sorting an already-sorted list is a linear-time operation.
     index = pages.Index(rectype, slugs, reclist, typeconfig['per_index'])
     index['is_dir_index'] = True
-    index['trail'] = site.trail_from_src(dirpath)
+    index['trail'] = site.trail_from_src(srcdir.path)
     index.render()
 
     return reclist
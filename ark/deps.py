@@ -0,0 +1,139 @@
+# --------------------------------------------------------------------------
+# Tracks the inputs each output page depends on for incremental builds.
+#
+# When a page is rendered we record a signature of its inputs:
+#
+#   * the source files of the records it displays;
+#   * the site's includes and the theme's templates;
+#   * the site's configuration, flags, and loaded extensions;
+#   * the page's own attributes, e.g. its slugs and page number.
+#
+# The dependency graph is cached to disk between build runs. In an
+# incremental build a page is only rendered if its signature has changed
+# or its output file is missing. Extensions which add data to pages from
+# other sources can register additional dependencies on the
+# 'page_dependencies' filter hook.
+# --------------------------------------------------------------------------
+
+import os
+import hashlib
+import pickle
+
+from . import site
+from . import hooks
+from . import records
+from . import output
+
+
+# Stores the dependency graph from the previous and current build runs.
+# Maps output filepaths (relative to the output directory) to tuples
+# containing the page's signature and the list of its source records.
+_graph = { 'old': {}, 'new': {} }
+
+
+# Stores the signature of the inputs shared by every page.
+_shared = None
+
+
+# Page attributes which are accounted for elsewhere in the signature.
+_skipkeys = ('site', 'inc', 'includes', 'flags', 'record', 'records')
+
+
+# Loads the dependency graph from the last build run. If the last build ran
+# in this process we reuse its graph directly.
+@hooks.register('init_build')
+def load():
+    global _shared
+    _shared = None
+    if _graph['new']:
+        _graph['old'], _graph['new'] = _graph['new'], {}
+    elif os.path.isfile(site.home('.arkcache', 'deps.pickle')):
+        with open(site.home('.arkcache', 'deps.pickle'), 'rb') as file:
+            _graph['old'] = pickle.load(file)
+
+
+# Caches the dependency graph to disk for the next build run. Pages
+# rendered in live mode or into an archive aren't written to the output
+# directory so their entries would be invalid for the next build.
+@hooks.register('exit')
+def save():
+    if _graph['new'] and not site.live() and not site.archive():
+        if not os.path.isdir(site.home('.arkcache')):
+            os.makedirs(site.home('.arkcache'))
+        with open(site.home('.arkcache', 'deps.pickle'), 'wb') as file:
+            pickle.dump(_graph['new'], file)
+
+
+# Discard any entries copied from the parent process when a worker starts.
+@hooks.register('init_worker')
+def init_worker():
+    _graph['new'] = {}
+
+
+# Hand the entries recorded by a worker process back to the parent.
+@hooks.register('worker_state')
+def export_worker_deps(state):
+    state['deps'], _graph['new'] = _graph['new'], {}
+    return state
+
+
+# Merge the entries recorded by a worker process.
+@hooks.register('merge_worker_state')
+def merge_worker_deps(state):
+    _graph['new'].update(state['deps'])
+
+
+# Records the dependencies of a page whose output filepath has been set.
+# Returns true if this is an incremental build and the page's output file
+# is up to date, i.e. the page doesn't need to be rendered.
+def unchanged(page):
+    key = os.path.relpath(page['path'], site.out())
+    srcs = sources(page)
+    _graph['new'][key] = (signature(page, srcs), srcs)
+    if site.incremental() and output.exists(page['path']):
+        return _graph['old'].get(key) == _graph['new'][key]
+    return False
+
+
+# Returns the list of record source files displayed on a page.
+def sources(page):
+    srcs = [page['record']['src']] if page['record'] else []
+    srcs.extend(record['src'] for record in page['records'])
+    return srcs
+
+
+# Returns a signature digest for the inputs to the specified page. Values
+# whose repr() isn't stable between runs, e.g. arbitrary objects, simply
+# cause the page to be rendered every time.
+def signature(page, srcs):
+    hash = hashlib.sha1(shared().encode())
+
+    for src in srcs:
+        hash.update(src.encode())
+        hash.update(records.srcdigest(src).encode())
+
+    for key in sorted(page):
+        if not key in _skipkeys:
+            hash.update(('%s=%r' % (key, page[key])).encode())
+
+    for dependency in hooks.filter('page_dependencies', [], page):
+        hash.update(repr(dependency).encode())
+
+    return hash.hexdigest()
+
+
+# Returns a signature digest for the inputs shared by every page.
+def shared():
+    global _shared
+    if _shared is None:
+        hash = hashlib.sha1(records.fingerprint().encode())
+        hash.update(site.theme().encode())
+        for dirpath in (site.theme('templates'), site.inc()):
+            for path, dirnames, filenames in sorted(os.walk(dirpath)):
+                for name in sorted(filenames):
+                    stat = os.stat(os.path.join(path, name))
+                    hash.update(os.path.join(path, name).encode())
+                    hash.update(str(stat.st_mtime_ns).encode())
+                    hash.update(str(stat.st_size).encode())
+        _shared = hash.hexdigest()
+    return _shared
@@ -10,14 +10,13 @@ import sys
 import shutil
 import datetime
 import subprocess
-import http.server
 import webbrowser
-import hashlib
-import subprocess
-import time
+import threading
+import json
 
 import clio
-from ark import build, hooks, meta, site, utils
+import ark.server
+from ark import build, hooks, meta, site, utils, watcher
 
 
 # Application help text.
@@ -57,16 +56,55 @@ Usage: %s build [FLAGS] [OPTIONS]
   the global theme library specififed by the $ARK_THEMES environment
   variable.
 
+  Output files produced by a previous build which are no longer produced,
+  e.g. the pages of deleted records, are deleted at the end of the build.
+  Other files in the output directory are left untouched.
+
+  The --incremental flag skips rendering any page whose inputs, i.e. its
+  records, the site's includes and templates, and the site's configuration,
+  are unchanged since the last build.
+
+  The --low-memory flag keeps the text and html content of records on disk
+  rather than in memory. Content is loaded on demand and a limited number
+  of recently used records are cached in memory. (The cache size can be set
+  via a 'lowmem_cache' variable in the site's config file.)
+
+  The --profile-hooks flag records the number of calls and the time spent
+  in each event and filter hook and each registered handler, and prints a
+  table of the results at the end of the build. The --profile-json option
+  also writes the results to the specified file in JSON format.
+
+  The --jobs option spreads the work of parsing and rendering records over
+  multiple worker processes. (This option requires a platform which
+  supports forking, otherwise the site is built serially.)
+
+  The --archive option builds the site into an archive rather than the
+  output directory. The format is determined by the file extension: .tar,
+  .tar.gz, .tgz, .tar.zst, .tzst, or .zip. (Zstandard compression requires
+  the zstandard library.) Specify '-' to write a tar stream to stdout.
+
+  The --gzip flag writes a precompressed .gz copy alongside each HTML, CSS,
+  JavaScript, and other text file in the output.
+
 Options:
+  -a, --archive <path>
+                      Build the site into an archive file.
   -i, --inc <path>    Override the default 'inc' directory.
+  -j, --jobs <int>    Number of worker processes to use. Defaults to 1.
   -l, --lib <path>    Override the default 'lib' directory.
   -o, --out <path>    Override the default 'out' directory.
+      --profile-json <path>
+                      Write hook profiling data to a JSON file.
   -s, --src <path>    Override the default 'src' directory.
   -t, --theme <name>  Override the theme specififed in the config file.
 
 Flags:
   -c, --clear         Clear the output directory before building.
       --help          Print the build command's help text and exit.
+  -z, --gzip          Write precompressed .gz copies of text files.
+  -m, --low-memory    Load record content from disk on demand.
+  -n, --incremental   Only render pages whose inputs have changed.
+      --profile-hooks Print a table of time spent in each hook.
 
 """ % os.path.basename(sys.argv[0])
 
@@ -120,9 +158,20 @@ Flags:
 
 # Help text for the serve command.
 servehelp = """
-Usage: %s serve [FLAGS] [OPTIONS]
+Usage: %s serve [FLAGS] [OPTIONS] [ARGUMENTS]
+
+  Serve the site's output directory using a multi-threaded web server.
 
-  Serve the site's output directory using Python's builtin web server.
+  Recently served files are cached in memory. (The cache size in megabytes
+  can be set via a 'serve_cache' variable in the site's config file.)
+  Responses support conditional requests via ETag and Last-Modified
+  headers. Precompressed .br and .gz files are served in place of the
+  original files to clients which accept them.
+
+  The --live flag builds the site in the server's process and serves pages
+  directly from memory without writing them to disk. The site is watched
+  for changes and rebuilt incrementally; requests wait for any pending
+  rebuild. Arguments are passed to the build as build flags.
 
   Host IP defaults to localhost (127.0.0.1). Specify an IP address to serve
   only on that address or '0.0.0.0' to serve an all available IPs.
@@ -137,23 +186,43 @@ Options:
 Flags:
   -b, --browser       Launch the default web browser to view the site.
       --help          Print the serve command's help text and exit.
+      --live          Build the site and serve pages from memory.
 
 """ % os.path.basename(sys.argv[0])
 
 
 # Help text for the watch command.
 watchhelp = """
-Usage: %s watch [FLAGS]
+Usage: %s watch [FLAGS] [OPTIONS] [ARGUMENTS]
 
   Monitor the site directory and automatically rebuild the site when any
   file changes are detected.
 
-  Arguments passed to this command will be passed along to the 'build'
-  command. You can pass options or flags to the 'build' command by preceding
-  them with '--'.
+  The site is rebuilt in a long-running process which keeps the site's
+  records and templates loaded between builds. After the initial build
+  only pages whose inputs have changed are rendered. A burst of changes,
+  e.g. saving several files at once, triggers a single rebuild.
+
+  On Linux changes are detected using inotify. On other platforms the site
+  directory is polled for changes. Changes to the site's config file or
+  extensions restart the watch process.
+
+  Arguments are passed to the build as build flags. This command accepts
+  the same options and flags as the 'build' command.
+
+Options:
+  -i, --inc <path>    Override the default 'inc' directory.
+  -j, --jobs <int>    Number of worker processes to use. Defaults to 1.
+  -l, --lib <path>    Override the default 'lib' directory.
+  -o, --out <path>    Override the default 'out' directory.
+  -s, --src <path>    Override the default 'src' directory.
+  -t, --theme <name>  Override the theme specififed in the config file.
 
 Flags:
-  --help              Print the watch command's help text and exit.
+  -c, --clear         Clear the output directory before the initial build.
+      --help          Print the watch command's help text and exit.
+  -m, --low-memory    Load record content from disk on demand.
+  -n, --incremental   Only render changed pages in the initial build.
 
 """ % os.path.basename(sys.argv[0])
 
@@ -164,15 +233,11 @@ def cli():
     parser = clio.ArgParser(apphelp, meta.__version__)
 
     build_parser = parser.add_cmd("build", cmd_build, buildhelp)
-    build_parser.add_flag("clear", "c")
-    build_parser.add_str_opt("out", None, "o")
-    build_parser.add_str_opt("src", None, "s")
-    build_parser.add_str_opt("lib", None, "l")
-    build_parser.add_str_opt("inc", None, "i")
-    build_parser.add_str_opt("theme", None, "t")
+    add_build_options(build_parser)
 
     serve_parser = parser.add_cmd("serve", cmd_serve, servehelp)
     serve_parser.add_flag("browser", "b")
+    serve_parser.add_flag("live")
     serve_parser.add_str_opt("host", "localhost", "h")
     serve_parser.add_int_opt("port", 8080, "p")
 
@@ -182,6 +247,7 @@ def cli():
     clear_parser = parser.add_cmd("clear", cmd_clear, clearhelp)
     edit_parser = parser.add_cmd("edit", cmd_edit, edithelp)
     watch_parser = parser.add_cmd("watch", cmd_watch, watchhelp)
+    add_build_options(watch_parser)
 
     hooks.event('init_clio', parser)
 
@@ -190,11 +256,25 @@ def cli():
       parser.help()
 
 
-# Callback for the build command.
-def cmd_build(parser):
-    if not site.home():
-        sys.exit("Error: cannot locate the site's home directory.")
-
+# Registers the options and flags shared by the build and watch commands.
+def add_build_options(parser):
+    parser.add_flag("clear", "c")
+    parser.add_flag("incremental", "n")
+    parser.add_flag("low-memory", "m")
+    parser.add_str_opt("out", None, "o")
+    parser.add_str_opt("src", None, "s")
+    parser.add_str_opt("lib", None, "l")
+    parser.add_str_opt("inc", None, "i")
+    parser.add_str_opt("theme", None, "t")
+    parser.add_int_opt("jobs", 1, "j")
+    parser.add_flag("profile-hooks")
+    parser.add_str_opt("profile-json", None)
+    parser.add_str_opt("archive", None, "a")
+    parser.add_flag("gzip", "z")
+
+
+# Applies the options and flags shared by the build and watch commands.
+def apply_build_options(parser):
     if parser['out']: site.setconfig('[out]', parser['out'])
     if parser['src']: site.setconfig('[src]', parser['src'])
     if parser['lib']: site.setconfig('[lib]', parser['lib'])
@@ -203,9 +283,43 @@ def cmd_build(parser):
     if parser['theme']:
         site.setconfig('[theme]', site.find_theme(parser['theme']))
 
+    if parser['incremental']:
+        site.setconfig('[incremental]', True)
+
+    if parser['low-memory']:
+        site.setconfig('[lowmem]', True)
+
+    if parser['jobs'] > 1:
+        site.setconfig('[jobs]', parser['jobs'])
+
+    if parser['archive'] == '-':
+        site.setconfig('[archive]', '-')
+    elif parser['archive']:
+        site.setconfig('[archive]', os.path.abspath(parser['archive']))
+
+    if parser['gzip']:
+        site.setconfig('[gzip]', True)
+
+    if parser['profile-hooks'] or parser['profile-json']:
+        hooks.enable_profiling()
+
+        @hooks.register('exit', 100)
+        def profile_callback():
+            if parser['profile-hooks']:
+                print_hook_profile(hooks.profile())
+            if parser['profile-json']:
+                dump_hook_profile(hooks.profile(), parser['profile-json'])
+
     if parser['clear']:
         utils.cleardir(site.out())
 
+
+# Callback for the build command.
+def cmd_build(parser):
+    if not site.home():
+        sys.exit("Error: cannot locate the site's home directory.")
+
+    apply_build_options(parser)
     site.setconfig('[flags]', parser.get_args())
 
     @hooks.register('main')
@@ -216,6 +330,42 @@ def cmd_build(parser):
             sys.exit("Error: cannot locate the site's source directory.")
 
 
+# Prints a table of hook profiling data. Hooks are ranked by their total
+# time, with each hook's handlers ranked beneath it.
+def print_hook_profile(profile):
+    row = "%-50s %8s %10s %10s"
+    print("-" * 80)
+    print(row % ("Hook / Handler", "Calls", "Total (s)", "Max (s)"))
+    print("-" * 80)
+
+    ranked = sorted(profile['hooks'].items(), key=lambda i: -i[1][1])
+    for hook, (calls, total, maximum) in ranked:
+        print(row % (hook, calls, "%.4f" % total, "%.4f" % maximum))
+        handlers = profile['handlers'].get(hook, {})
+        for name, (calls, total, maximum) in sorted(
+            handlers.items(), key=lambda i: -i[1][1]):
+            name = "  " + (name if len(name) <= 48 else "..." + name[-45:])
+            print(row % (name, calls, "%.4f" % total, "%.4f" % maximum))
+
+    print("-" * 80)
+
+
+# Writes hook profiling data to a file in JSON format.
+def dump_hook_profile(profile, path):
+    entry = lambda e: {'calls': e[0], 'total': e[1], 'max': e[2]}
+    data = {
+        'hooks': {
+            hook: entry(e) for hook, e in profile['hooks'].items()
+        },
+        'handlers': {
+            hook: {name: entry(e) for name, e in stats.items()}
+            for hook, stats in profile['handlers'].items()
+        },
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+
+
 # Callback for the init command.
 def cmd_init(parser):
     initdir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'ini')
@@ -275,15 +425,30 @@ def cmd_serve(parser):
     if not site.home():
         sys.exit("Error: cannot locate the site's home directory.")
 
-    if not os.path.exists(site.out()):
-        sys.exit("Error: cannot locate the site's output directory.")
+    if parser['live']:
+        if not os.path.isdir(site.src()):
+            sys.exit("Error: cannot locate the site's source directory.")
+
+        site.setconfig('[live]', True)
 
-    os.chdir(site.out())
+        @hooks.register('main')
+        def serve_callback():
+            serve(parser, LiveBuilder(parser.get_args()))
 
+    else:
+        if not os.path.exists(site.out()):
+            sys.exit("Error: cannot locate the site's output directory.")
+
+        serve(parser)
+
+
+# Runs the web server, optionally paired with a live builder.
+def serve(parser, builder=None):
     try:
-        server = http.server.HTTPServer(
+        server = ark.server.Server(
             (parser['host'], parser['port']),
-            http.server.SimpleHTTPRequestHandler
+            site.out(),
+            builder
         )
     except PermissionError:
         sys.exit("Permission error: use 'sudo' to run on a port number below 1024.")
@@ -297,6 +462,9 @@ def cmd_serve(parser):
     print("Stop: Ctrl-C")
     print("-" * 80)
 
+    if builder:
+        builder.start()
+
     if parser['browser']:
         webbrowser.open("http://%s:%s" % (parser['host'], parser['port']))
 
@@ -307,57 +475,151 @@ def cmd_serve(parser):
         server.server_close()
 
 
-# Callback for the watch command. Python doesn't have a builtin file system
-# watcher so we hack together one of our own.
+# Callback for the watch command. The site is rebuilt in this process
+# whenever a change is detected so extensions, templates, and the record
+# cache stay loaded between builds. Rebuilds after the initial build are
+# incremental, i.e. only pages whose inputs have changed are rendered.
 def cmd_watch(parser):
-    home = site.home()
-    args = [sys.argv[0], 'build', 'watching'] + parser.get_args()
+    if not site.home():
+        sys.exit("Error: cannot locate the site's home directory.")
+
+    if not os.path.isdir(site.src()):
+        sys.exit("Error: cannot locate the site's source directory.")
+
+    apply_build_options(parser)
+
+    @hooks.register('main')
+    def watch_callback():
+        watch(parser.get_args())
+
+
+# Watches the site for changes, rebuilding it in this process.
+def watch(flags):
+
+    monitor = watch_site()
 
     print("-" * 80)
-    print("Site: %s" % home)
+    print("Site: %s" % site.home())
+    print("Mode: %s" % type(monitor).__name__)
     print("Stop: Ctrl-C")
     print("-" * 80)
 
     # Build the site at least once with the 'watching' flag.
-    print("Running intial build.")
-    subprocess.call(args)
+    print("Running initial build.")
+    site.setconfig('[flags]', ['watching'] + flags)
+    watch_build(build.build_site)
+    site.setconfig('[incremental]', True)
     print("-" * 80)
 
-    # Create a hash digest of the site directory.
-    oldhash = hashsite(home)
-
     # Loop until the user hits Ctrl-C.
     try:
         while True:
-            newhash = hashsite(home)
-            if newhash != oldhash:
-                print("Building site.")
-                subprocess.call(args)
-                newhash = hashsite(home)
-            oldhash = newhash
-            time.sleep(0.5)
+            changes = monitor.wait()
+            check_restart(changes, monitor)
+            print("Building site: %s changed." % (
+                "1 file" if len(changes) == 1 else "%s files" % len(changes)
+            ))
+            watch_build(build.rebuild)
     except KeyboardInterrupt:
         pass
 
     # Build the site one last time without the 'watching' flag.
     print("\n" + "-" * 80 + "Running final build.\n" + "-" * 80)
-    subprocess.call(arg for arg in args if arg != 'watching')
-
-
-# Returns a hash digest of the site directory.
-def hashsite(sitedirpath):
-    hash = hashlib.sha256()
-
-    def hashdir(dirpath, is_home):
-        for finfo in utils.files(dirpath):
-            mtime = os.path.getmtime(finfo.path)
-            hash.update(str(mtime).encode())
-            hash.update(finfo.name.encode())
-
-        for dinfo in utils.subdirs(dirpath):
-            if is_home and dinfo.name in ('out'):
-                continue
-            hashdir(dinfo.path, False)
-
-    hashdir(sitedirpath, True)
-    return hash.digest()
+    monitor.close()
+    site.setconfig('[flags]', flags)
+    build.rebuild()
+
+
+# Returns a watcher for the site directory and the theme directory if it
+# lives elsewhere. The output and cache directories are ignored.
+def watch_site():
+    dirpaths = [site.home()]
+    if not within(site.theme(), site.home()):
+        dirpaths.append(site.theme())
+    return watcher.watch(dirpaths, [site.out(), site.home('.arkcache')])
+
+
+# Changes to the site's configuration file or extensions can't be applied to
+# a running process so we restart the current command.
+def check_restart(changes, monitor):
+    for path in changes:
+        if path == site.home('config.py') or (
+            within(path, site.home('ext')) and path.endswith('.py')):
+            print("Configuration changed, restarting.")
+            monitor.close()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+# Runs a build while watching the site. Errors which would normally exit
+# the application are reported and the watcher keeps running.
+def watch_build(callback):
+    try:
+        callback()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            print(e.code)
+        return
+    rendered, written = site.rendered(), site.written()
+    print("%s rendered, %s written in %.2f seconds." % (
+        "1 page" if rendered == 1 else "%s pages" % rendered,
+        "1 page" if written == 1 else "%s pages" % written,
+        site.runtime(),
+    ))
+
+
+# Returns true if path is the same as or is located below parent.
+def within(path, parent):
+    path, parent = os.path.abspath(path), os.path.abspath(parent)
+    return path == parent or path.startswith(parent + os.sep)
+
+
+# A LiveBuilder instance rebuilds the site in memory when serving the site
+# in live mode. Rebuilds run in a background thread or, if a request arrives
+# before the background thread has picked up a change, in the request's
+# thread.
+class LiveBuilder:
+
+    def __init__(self, flags):
+        self.flags = flags
+        self.lock = threading.Lock()
+        self.monitor = watch_site()
+
+    # Runs the initial build and starts watching the site for changes.
+    def start(self):
+        print("Running initial build.")
+        site.setconfig('[flags]', ['watching'] + self.flags)
+        watch_build(build.build_site)
+        site.setconfig('[incremental]', True)
+        print("-" * 80)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Rebuilds the site whenever changes are detected. We take the lock as
+    # soon as the first change arrives so requests wait for the rebuild
+    # rather than being served stale pages.
+    def run(self):
+        while True:
+            changes = self.monitor.poll(None)
+            if changes:
+                with self.lock:
+                    self.rebuild(changes)
+
+    # Called by the server before handling each request. Blocks while a
+    # rebuild is in progress. Changes the watcher has seen but not yet
+    # handed to the background thread, e.g. a file saved a moment before
+    # the request, are drained and rebuilt first so the request never sees
+    # a stale page.
+    def refresh(self):
+        with self.lock:
+            changes = self.monitor.poll(0)
+            if changes:
+                self.rebuild(changes)
+
+    # Rebuilds the site for a set of changes. The caller must hold the lock.
+    def rebuild(self, changes):
+        changes = self.monitor.settle(changes)
+        check_restart(changes, self.monitor)
+        print("Building site: %s changed." % (
+            "1 file" if len(changes) == 1
+            else "%s files" % len(changes)
+        ))
+        watch_build(build.rebuild)
@@ -1,6 +1,9 @@
 # --------------------------------------------------------------------------
 # This extension adds support for Ibis templates to Ark.
 #
+# Time spent compiling templates is recorded on the 'compile' timer and on a
+# timer for each template, e.g. 'template:page.ibis'.
+#
 # Author: Darren Mulholland <darren@mulholland.xyz>
 # License: Public Domain
 # --------------------------------------------------------------------------
@@ -8,6 +11,8 @@
 import ark
 import ibis
 import sys
+import os
+import time
 
 
 # Initialize our Ibis template loader on the 'init' event hook.
@@ -16,6 +21,43 @@ def init():
     ibis.config.loader = ibis.loaders.FileLoader(ark.site.theme('templates'))
 
 
+# Stores the (mtime, size) stamps of the templates loaded for the last build.
+stamps = None
+
+
+# Precompile the theme's Ibis templates on the 'init_templates' event hook.
+# This reports any template syntax errors before the build gets under way.
+# The loader caches compiled templates so if the site is rebuilt in the same
+# process, e.g. when watching for changes, we start a fresh loader if any
+# template has changed.
+@ark.hooks.register('init_templates')
+def precompile():
+    global stamps
+    filenames = ark.templates.filenames('ibis')
+    current = {}
+    for filename in filenames:
+        stat = os.stat(os.path.join(ark.site.theme('templates'), filename))
+        current[filename] = (stat.st_mtime_ns, stat.st_size)
+    if stamps is not None and current != stamps:
+        init()
+    stamps = current
+
+    for filename in filenames:
+        start = time.perf_counter()
+        try:
+            ibis.config.loader(filename)
+        except ibis.errors.TemplateError as e:
+            msg =  "-----------------------\n"
+            msg += "  Ibis Template Error  \n"
+            msg += "-----------------------\n\n"
+            msg += "  Template: %s\n\n" % filename
+            msg += "  %s: %s" % (e.__class__.__name__, e)
+            sys.exit(msg)
+        seconds = time.perf_counter() - start
+        ark.site.timer('compile', seconds)
+        ark.site.timer('template:%s' % filename, seconds)
+
+
 # Register our template engine callback for files with a .ibis extension.
 @ark.templates.register('ibis')
 def callback(page, filename):
@@ -1,6 +1,12 @@
 # --------------------------------------------------------------------------
 # This extension adds support for Jinja templates to Ark.
 #
+# Compiled templates are cached as bytecode in the site's .arkcache
+# directory. Set `jinja_precompile = True` in the site's config file to
+# compile the entire theme at the start of each build. Time spent loading
+# and compiling templates is recorded on the 'compile' timer and on a timer
+# for each template, e.g. 'template:page.jinja'.
+#
 # Author: Darren Mulholland <darren@mulholland.xyz>
 # License: Public Domain
 # --------------------------------------------------------------------------
@@ -8,19 +14,26 @@
 import ark
 import jinja2
 import sys
+import os
+import time
 
 
 # Stores an initialized Jinja environment instance.
 env = None
 
 
+# Stores the names of templates which have already been loaded.
+loaded = set()
+
+
 # Initialize our Jinja environment on the 'init' event hook.
 @ark.hooks.register('init')
 def init():
 
-    # Initialize a template loader.
+    # Initialize a template loader and a bytecode cache.
     settings = {
-        'loader': jinja2.FileSystemLoader(ark.site.theme('templates'))
+        'loader': jinja2.FileSystemLoader(ark.site.theme('templates')),
+        'bytecode_cache': jinja2.FileSystemBytecodeCache(cachedir()),
     }
 
     # Check the site's config file for any custom settings.
@@ -31,20 +44,61 @@ def init():
     env = jinja2.Environment(**settings)
 
 
+# Returns the path to the bytecode cache directory.
+def cachedir():
+    return ark.site.home('.arkcache', 'jinja')
+
+
+# Precompile the theme's Jinja templates on the 'init_templates' event hook
+# if the site's config file asks us to. We also make sure the bytecode
+# cache directory exists as the cache won't create it.
+@ark.hooks.register('init_templates')
+def precompile():
+    filenames = ark.templates.filenames('jinja')
+    if filenames and not os.path.isdir(cachedir()):
+        os.makedirs(cachedir())
+    if ark.site.config('jinja_precompile'):
+        for filename in filenames:
+            try:
+                load(filename)
+            except jinja2.TemplateError as e:
+                exit_with_error(e, filename)
+
+
+# Loads a template, recording the time taken on its first load.
+def load(filename):
+    if filename in loaded:
+        return env.get_template(filename)
+    start = time.perf_counter()
+    template = env.get_template(filename)
+    seconds = time.perf_counter() - start
+    ark.site.timer('compile', seconds)
+    ark.site.timer('template:%s' % filename, seconds)
+    loaded.add(filename)
+    return template
+
+
 # Register our template engine callback for files with a .jinja extension.
 @ark.templates.register('jinja')
 def callback(page, filename):
     try:
-        template = env.get_template(filename)
+        template = load(filename)
         return template.render(page)
     except jinja2.TemplateError as e:
-        msg =  "------------------------\n"
-        msg += "  Jinja Template Error  \n"
-        msg += "------------------------\n\n"
-        msg += "  Template: %s\n" % filename
-        msg += "  Page:     %s\n\n" % page['path']
-        msg += "  %s: %s" % (e.__class__.__name__, e)
-        if e.__context__:
-            msg += "\n\nThe following exception was reported:\n\n"
-            msg += "%s: %s" % (e.__context__.__class__.__name__, e.__context__)
-        sys.exit(msg)
+        exit_with_error(e, filename, page)
+
+
+# Exits with an error message describing a template error.
+def exit_with_error(e, filename, page=None):
+    msg =  "------------------------\n"
+    msg += "  Jinja Template Error  \n"
+    msg += "------------------------\n\n"
+    msg += "  Template: %s\n" % filename
+    if page:
+        msg += "  Page:     %s\n" % page['path']
+    msg += "\n"
+    msg += "  %s: %s" % (e.__class__.__name__, e)
+    if e.__context__:
+        msg += "\n\nThe following exception was reported:\n\n"
+        msg += "%s: %s" % (e.__context__.__class__.__name__, e.__context__)
+    sys.exit(msg)
@@ -3,32 +3,80 @@
 #
 # Files with a .md extension will be rendered as Markdown.
 #
+# Markdown converters aren't thread-safe so each thread creates and reuses
+# its own converter. Worker processes are forked so each worker inherits a
+# copy of the parent's converter and likewise creates its own per thread.
+#
+# Rendered output is cached by the digest of the input text and the
+# renderer's settings in a bounded LRU cache. (The number of cached entries
+# can be set via a 'markdown_cache' variable in the site's config file.) The
+# cache is disabled in low-memory mode.
+#
 # Author: Darren Mulholland <darren@mulholland.xyz>
 # License: Public Domain
 # --------------------------------------------------------------------------
 
 import ark
 import markdown
+import hashlib
+import threading
+import collections
+
+
+# Stores the settings for the markdown renderer.
+settings = {}
+
+
+# Stores a digest of the renderer's settings.
+fingerprint = b''
+
 
+# Stores each thread's markdown converter.
+_local = threading.local()
 
-# Stores an initialized markdown renderer.
-mdrenderer = None
 
+# Stores an LRU cache mapping digests of input text and settings to html.
+_cache = collections.OrderedDict()
 
-# Initialize our markdown renderer on the 'init' event hook.
+
+# Guards the cache as records may be rendered by multiple threads.
+_lock = threading.Lock()
+
+
+# Load the renderer's settings on the 'init' event hook.
 @ark.hooks.register('init')
 def init():
 
     # Check the site's config file for customized settings for the
     # markdown renderer.
+    global settings, fingerprint
     settings = ark.site.config('markdown', {})
+    fingerprint = repr(sorted(settings.items(), key=repr)).encode('utf-8')
+    _local.__dict__.clear()
 
-    # Initialize a markdown renderer.
-    global mdrenderer
-    mdrenderer = markdown.Markdown(**settings)
+
+# Returns the markdown converter for the current thread.
+def converter():
+    if not hasattr(_local, 'converter'):
+        _local.converter = markdown.Markdown(**settings)
+    return _local.converter
 
 
 # Register our callback to render files with a .md extension.
 @ark.renderers.register('md')
 def render(text):
-    return mdrenderer.reset().convert(text)
+    if ark.site.lowmem():
+        return converter().reset().convert(text)
+
+    key = hashlib.sha1(text.encode('utf-8') + b'\0' + fingerprint).digest()
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    html = converter().reset().convert(text)
+    with _lock:
+        _cache[key] = html
+        while len(_cache) > ark.site.config('markdown_cache', 256):
+            _cache.popitem(last=False)
+    return html
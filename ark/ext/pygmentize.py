@@ -9,40 +9,160 @@
 # not be found the filter will return the input text with any HTML special
 # characters escaped.
 #
+# Lexers and the formatter are created once per language and reused.
+# Highlighted output is cached in the site's .arkcache directory, keyed by
+# the digest of the code and its language, so unchanged code blocks aren't
+# highlighted again on the next build run. The cache is discarded if the
+# installed version of Pygments changes.
+#
+# If no language is specified we look for a #! line before falling back on
+# a default language which can be set via a 'pygmentize_default' variable in
+# the site's config file. Pygments' (slow) guess_lexer() function is only
+# used if neither is available.
+#
 # Author: Darren Mulholland <darren@mulholland.xyz>
 # License: Public Domain
 # --------------------------------------------------------------------------
 
+import os
 import html
 import ibis
+import ark
+import pickle
+import hashlib
 
 
 try:
     import pygments
+    import pygments.util
     import pygments.lexers
     import pygments.formatters
 except ImportError:
     pygments = None
 
 
+# Maps language names to lexer instances, or to None if there is no lexer
+# for the language.
+_lexers = {}
+
+
+# Stores the formatter instance shared by all languages.
+_formatter = None
+
+
+# Stores highlighted output from the previous and current build runs. Each
+# cache maps a digest of the code and its language to html.
+_cache = { 'old': None, 'new': {} }
+
+
 @ibis.filters.register('pygmentize')
 def pygmentize(text, lang=None):
-    if pygments:
-        if lang:
-            try:
-                lexer = pygments.lexers.get_lexer_by_name(lang)
-            except pygments.util.ClassNotFound:
-                lexer = None
-        else:
-            try:
-                lexer = pygments.lexers.guess_lexer(text)
-            except pygments.util.ClassNotFound:
-                lexer = None
+    if not pygments:
+        return html.escape(text)
+
+    lang = lang or sniff(text) or ark.site.config('pygmentize_default')
+    key = hashlib.sha1(('%s\0%s' % (lang, text)).encode('utf-8')).digest()
+    if _cache['old'] is None:
+        load()
+    output = _cache['new'].get(key) or _cache['old'].get(key)
+
+    if output is None:
+        lexer = getlexer(lang, text)
         if lexer:
-            formatter = pygments.formatters.HtmlFormatter(nowrap=True)
-            text = pygments.highlight(text, lexer, formatter)
+            output = pygments.highlight(text, lexer, getformatter())
         else:
-            text = html.escape(text)
-    else:
-        text = html.escape(text)
-    return text
+            output = html.escape(text)
+    _cache['new'][key] = output
+    return output
+
+
+# Returns the language named on a #! line at the start of the text, if any.
+def sniff(text):
+    if text.startswith('#!'):
+        words = text[2:].split('\n', 1)[0].split()
+        if words and os.path.basename(words[0]) == 'env':
+            words = words[1:]
+        if words:
+            name = os.path.basename(words[0]).rstrip('0123456789.')
+            if getlexer(name):
+                return name
+    return None
+
+
+# Returns the lexer for the specified language or None. If no language is
+# specified we try to guess the language of the text. Guessed lexers aren't
+# cached as they depend on the text.
+def getlexer(lang, text=None):
+    if not lang:
+        try:
+            return pygments.lexers.guess_lexer(text)
+        except pygments.util.ClassNotFound:
+            return None
+    if not lang in _lexers:
+        try:
+            _lexers[lang] = pygments.lexers.get_lexer_by_name(lang)
+        except pygments.util.ClassNotFound:
+            _lexers[lang] = None
+    return _lexers[lang]
+
+
+# Returns the shared formatter instance.
+def getformatter():
+    global _formatter
+    if _formatter is None:
+        _formatter = pygments.formatters.HtmlFormatter(nowrap=True)
+    return _formatter
+
+
+# Returns the path to the highlighting cache file.
+def cachefile():
+    return ark.site.home('.arkcache', 'pygments.pickle')
+
+
+# Loads the highlighting cache from the last build run.
+def load():
+    _cache['old'] = {}
+    if os.path.isfile(cachefile()):
+        with open(cachefile(), 'rb') as file:
+            data = pickle.load(file)
+        if data['version'] == pygments.__version__:
+            _cache['old'] = data['entries']
+
+
+# If the last build ran in this process, e.g. when watching the site for
+# changes, its output becomes the old cache for the next build.
+@ark.hooks.register('init_build')
+def rotate():
+    if _cache['new']:
+        _cache['old'], _cache['new'] = _cache['new'], {}
+
+
+# Caches the output of the current build run to disk. Only code blocks seen
+# during this build are kept so the cache doesn't grow without limit.
+@ark.hooks.register('exit')
+def save():
+    if _cache['new'] and _cache['new'] != _cache['old']:
+        if not os.path.isdir(ark.site.home('.arkcache')):
+            os.makedirs(ark.site.home('.arkcache'))
+        data = {'version': pygments.__version__, 'entries': _cache['new']}
+        with open(cachefile(), 'wb') as file:
+            pickle.dump(data, file)
+
+
+# Discard any output copied from the parent process when a worker starts.
+@ark.hooks.register('init_worker')
+def init_worker():
+    _cache['new'] = {}
+
+
+# Hand the output cached by a worker process back to the parent.
+@ark.hooks.register('worker_state')
+def export_worker_cache(state):
+    state['pygments'], _cache['new'] = _cache['new'], {}
+    return state
+
+
+# Merge the output cached by a worker process.
+@ark.hooks.register('merge_worker_state')
+def merge_worker_cache(state):
+    _cache['new'].update(state['pygments'])
@@ -1,6 +1,15 @@
 # --------------------------------------------------------------------------
 # This extension adds support for shortcodes to Ark.
 #
+# The output of shortcodes declared pure, i.e. whose output depends only on
+# their arguments and content, is cached for the lifetime of the process.
+# A shortcode can be declared pure using the @pure decorator below or by
+# listing its keyword in a 'pure_shortcodes' variable in the site's config
+# file.
+#
+# The time spent in each shortcode's handler is recorded on a named timer,
+# e.g. 'shortcode:foo', and included in the build report.
+#
 # Author: Darren Mulholland <darren@mulholland.xyz>
 # License: Public Domain
 # --------------------------------------------------------------------------
@@ -8,12 +17,30 @@
 import ark
 import shortcodes
 import sys
+import time
 
 
 # Stores an initialized shortcodes.Parser() instance.
 scparser = None
 
 
+# Stores the cached output of pure shortcodes.
+_cache = {}
+
+
+# Decorator function for declaring a shortcode handler pure. Apply it below
+# the shortcode's registration decorator, e.g.
+#
+#     @shortcodes.register('foo')
+#     @ark.ext.sc_support.pure
+#     def handler(pargs, kwargs, context):
+#         ...
+#
+def pure(func):
+    func.pure = True
+    return func
+
+
 # Initialize our shortcode parser on the 'init' event hook.
 @ark.hooks.register('init')
 def init():
@@ -24,7 +51,46 @@ def init():
 
     # Initialize a single parser instance.
     global scparser
-    scparser = shortcodes.Parser(**settings)
+    scparser = Parser(**settings)
+
+
+class Parser(shortcodes.Parser):
+
+    """ A shortcode parser which wraps each handler as it's registered. """
+
+    def __init__(self, **settings):
+        shortcodes.Parser.__init__(self, **settings)
+
+        # Wrap the handlers inherited from the global registry.
+        for keyword, (func, endword) in list(self.keywords.items()):
+            self.register(func, keyword, endword)
+
+    def register(self, func, keyword, endword=None):
+        shortcodes.Parser.register(self, wrap(keyword, func), keyword, endword)
+
+
+# Returns a shortcode handler wrapped to record its timing and to cache its
+# output if it's pure.
+def wrap(keyword, func):
+    timer = 'shortcode:%s' % keyword
+    ispure = getattr(func, 'pure', False) or \
+        keyword in ark.site.config('pure_shortcodes', [])
+
+    def wrapped(pargs, kwargs, context, *content):
+        if ispure:
+            key = (keyword, tuple(pargs), tuple(sorted(kwargs.items())), content)
+            if key in _cache:
+                return _cache[key]
+        begin = time.perf_counter()
+        try:
+            output = func(pargs, kwargs, context, *content)
+        finally:
+            ark.site.timer(timer, time.perf_counter() - begin)
+        if ispure:
+            _cache[key] = output
+        return output
+
+    return wrapped
 
 
 # Filter each record's content on the 'record_text' filter hook and render
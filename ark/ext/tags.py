@@ -42,10 +42,45 @@ def register_tags(record):
             record['tags'].append(Tag(tag, url(record['type'], tag)))
 
 
+# Discard any tag mappings copied from the parent process when a worker
+# process starts or left over from a previous build run in this process.
+@ark.hooks.register('init_build')
+@ark.hooks.register('init_worker')
+def clear_tags():
+    rmap.clear()
+    nmap.clear()
+
+
+# Hand the tag mappings registered by a worker process back to the parent.
+@ark.hooks.register('worker_state')
+def export_worker_tags(state):
+    state['tags'] = (dict(rmap), dict(nmap))
+    clear_tags()
+    return state
+
+
+# Merge the tag mappings registered by a worker process. Workers process
+# batches of records in order so appending preserves the serial ordering.
+@ark.hooks.register('merge_worker_state')
+def merge_worker_tags(state):
+    rmaps, nmaps = state['tags']
+    for rectype, recmap in rmaps.items():
+        for slug, filelist in recmap.items():
+            rmap.setdefault(rectype, {}).setdefault(slug, []).extend(filelist)
+    for rectype, namemap in nmaps.items():
+        for slug, name in namemap.items():
+            nmap.setdefault(rectype, {}).setdefault(slug, name)
+
+
 # Register a callback on the 'exit_build' event hook to build the tag index
 # pages.
 @ark.hooks.register('exit_build')
 def build_tag_indexes():
+    with ark.stats.timed('tag_indexes'):
+        _build_tag_indexes()
+
+
+def _build_tag_indexes():
 
     # Iterate over the site's record types.
     for rectype, recmap in rmap.items():
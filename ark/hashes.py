@@ -11,46 +11,236 @@
 #
 #   * We save on disk IO, which is more expensive than comparing hashes.
 #   * We avoid unnecessarily bumping the file modification time.
+#
+# Hashes don't need to be cryptographically secure so we use the fastest
+# available algorithm: xxHash if the xxhash library is installed, otherwise
+# BLAKE2b with a 128-bit digest. (An algorithm can be chosen via a
+# 'hash_algorithm' variable in the site's config file.)
+#
+# Hashes are cached in a compact binary file. The file contains a header, a
+# table of fixed-size entries sorted by key, and a block of keys. The file
+# is read into memory as a single buffer and lookups use a binary search of
+# the table so the file never needs to be parsed in full. (We don't map the
+# file into memory as a mapped file can't be replaced on Windows.)
 # --------------------------------------------------------------------------
 
 import os
+import sys
+import struct
 import hashlib
-import pickle
 
 from . import site
 from . import hooks
 
 
+# The xxhash library is optional.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# Maps algorithm names to functions which return the digest of a bytes
+# object.
+algorithms = {
+    'sha1': lambda data: hashlib.sha1(data).digest(),
+}
+
+if hasattr(hashlib, 'blake2b'):
+    algorithms['blake2b'] = \
+        lambda data: hashlib.blake2b(data, digest_size=16).digest()
+
+if xxhash and hasattr(xxhash, 'xxh3_128_digest'):
+    algorithms['xxh3_128'] = xxhash.xxh3_128_digest
+elif xxhash:
+    algorithms['xxh64'] = lambda data: xxhash.xxh64(data).digest()
+
+
+# File header: magic number, format version, algorithm name, entry count.
+_header = struct.Struct('<4sH16sI')
+
+
+# Table entry: key offset, key length. Each entry is followed by a digest.
+_entry = struct.Struct('<IH')
+
+
 # Stores page hashes from the previous and current build runs.
 _hashes = { 'old': {}, 'new': {} }
 
 
+# Stores the digest function of the algorithm in use.
+_digest = None
+
+
+# Returns the name of the hashing algorithm in use.
+def algorithm():
+    name = site.config('hash_algorithm')
+    if name:
+        if not name in algorithms:
+            sys.exit("Error: unsupported hash algorithm '%s'." % name)
+        return name
+    for name in ('xxh3_128', 'xxh64', 'blake2b'):
+        if name in algorithms:
+            return name
+    return 'sha1'
+
+
+# Returns the digest of a bytes object.
+def digest(data):
+    global _digest
+    if _digest is None:
+        _digest = algorithms[algorithm()]
+    return _digest(data)
+
+
+# Returns the path to the hash cache file.
+def path():
+    return site.home('.arkcache', 'hashes.bin')
+
+
 # Loads cached page hashes from the last build run.
 @hooks.register('init')
 def load():
-    if os.path.isfile(site.home('.arkcache', 'hashes.pickle')):
-        with open(site.home('.arkcache', 'hashes.pickle'), 'rb') as file:
-            _hashes['old'] = pickle.load(file)
+    if os.path.isfile(path()):
+        _hashes['old'] = HashFile.open(path(), algorithm())
+
+
+# If the last build ran in this process, e.g. when watching the site for
+# changes, its hashes become the old hashes for the next build. The digest
+# function is looked up again in case the site's settings have changed.
+@hooks.register('init_build')
+def rotate():
+    global _digest
+    _digest = None
+    if _hashes['new']:
+        _hashes['old'], _hashes['new'] = _hashes['new'], {}
 
 
-# Caches page hashes to disk for the next build run.
+# Caches page hashes to disk for the next build run. We write to a
+# temporary file and rename it so a reader never sees a partial file.
 @hooks.register('exit')
 def save():
     if _hashes['new']:
         if not os.path.isdir(site.home('.arkcache')):
             os.makedirs(site.home('.arkcache'))
-        with open(site.home('.arkcache', 'hashes.pickle'), 'wb') as file:
-            pickle.dump(_hashes['new'], file)
+        HashFile.write(path() + '.tmp', algorithm(), _hashes['new'])
+        os.replace(path() + '.tmp', path())
+
+
+# Discard any hashes copied from the parent process when a worker starts.
+@hooks.register('init_worker')
+def init_worker():
+    _hashes['new'] = {}
+
+
+# Hand the hashes computed by a worker process back to the parent.
+@hooks.register('worker_state')
+def export_worker_hashes(state):
+    state['hashes'], _hashes['new'] = _hashes['new'], {}
+    return state
+
+
+# Merge the hashes computed by a worker process.
+@hooks.register('merge_worker_state')
+def merge_worker_hashes(state):
+    _hashes['new'].update(state['hashes'])
 
 
 # Returns true if filepath is an existing file whose hash matches that of
-# the content string. We use the relative filepath as the key to avoid
-# leaking potentially sensitive information (e.g. usernames) if the hash
-# file is checked into a public version control repository.
+# the content. The content can be a string or the bytes to be written to
+# disk. We use the relative filepath as the key to avoid leaking
+# potentially sensitive information (e.g. usernames) if the hash file is
+# checked into a public version control repository.
 def match(filepath, content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
     key = os.path.relpath(filepath, site.out())
-    _hashes['new'][key] = hashlib.sha1(content.encode()).hexdigest()
+    _hashes['new'][key] = digest(content)
     if os.path.exists(filepath):
         return _hashes['old'].get(key) == _hashes['new'][key]
     else:
         return False
+
+
+# Carries the hash of an unchanged file over from the last build run.
+def keep(filepath):
+    key = os.path.relpath(filepath, site.out())
+    value = _hashes['old'].get(key)
+    if value is not None:
+        _hashes['new'][key] = value
+
+
+class HashFile:
+
+    """ A read-only mapping of keys to digests backed by a hash file. """
+
+    def __init__(self, buffer, count, size):
+        self.buffer = buffer
+        self.count = count
+        self.size = size
+        self.stride = _entry.size + size
+        self.keys = _header.size + count * self.stride
+
+    # Opens a hash file. Returns an empty dictionary if the file is invalid
+    # or was written using a different algorithm.
+    @classmethod
+    def open(cls, filepath, algorithm):
+        with open(filepath, 'rb') as file:
+            buffer = file.read()
+        if len(buffer) < _header.size:
+            return {}
+        magic, version, name, count = _header.unpack_from(buffer)
+        if magic != b'ARKH' or version != 1:
+            return {}
+        if name.rstrip(b'\0').decode() != algorithm:
+            return {}
+        if count == 0:
+            return {}
+        size = len(algorithms[algorithm](b''))
+        return cls(buffer, count, size)
+
+    # Writes a dictionary of hashes to a hash file.
+    @staticmethod
+    def write(filepath, algorithm, hashes):
+        keys = sorted(key.encode('utf-8') for key in hashes)
+        table, blob = [], []
+        offset = 0
+        for key in keys:
+            table.append(_entry.pack(offset, len(key)))
+            table.append(hashes[key.decode('utf-8')])
+            blob.append(key)
+            offset += len(key)
+        with open(filepath, 'wb') as file:
+            file.write(_header.pack(
+                b'ARKH', 1, algorithm.encode(), len(keys)
+            ))
+            file.write(b''.join(table))
+            file.write(b''.join(blob))
+
+    # Returns the key of the entry at the specified index.
+    def key(self, index):
+        offset, length = _entry.unpack_from(
+            self.buffer, _header.size + index * self.stride
+        )
+        start = self.keys + offset
+        return self.buffer[start:start + length]
+
+    def get(self, key, default=None):
+        target = key.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.key(mid) < target:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.count and self.key(low) == target:
+            start = _header.size + low * self.stride + _entry.size
+            return self.buffer[start:start + self.size]
+        return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.count
@@ -1,16 +1,43 @@
 # --------------------------------------------------------------------------
 # Event and filter hooks.
+#
+# Hooks can optionally be profiled. When profiling is enabled we record
+# the number of calls, the cumulative wall time, and the maximum wall time
+# for each hook and for each handler registered on it.
+#
+# Note that the record hooks ('record_text', 'record_html', 'init_record')
+# run in phases across a chunk of records rather than record by record.
+# See the ark.records module for details.
 # --------------------------------------------------------------------------
 
+import time
+
+
 # Maps hook names to lists of callback functions indexed by order.
 _handlers = {}
 
 
+# Maps hook names to tuples of callback functions sorted by order. These
+# are rebuilt on registration so firing a hook doesn't involve sorting.
+_flattened = {}
+
+
+# Stores profiling data if hook profiling has been enabled. The 'hooks'
+# dictionary maps hook names to [calls, total, max] lists. The 'handlers'
+# dictionary maps hook names to dictionaries of [calls, total, max] lists
+# indexed by handler name.
+_profile = None
+
+
 # Decorator function for registering event and filter handlers.
 def register(hook, order=0):
 
     def register_handler(func):
         _handlers.setdefault(hook, {}).setdefault(order, []).append(func)
+        _flattened[hook] = tuple(
+            func for order in sorted(_handlers[hook])
+            for func in _handlers[hook][order]
+        )
         return func
 
     return register_handler
@@ -18,14 +45,102 @@ def register(hook, order=0):
 
 # Fires an event hook.
 def event(hook, *args):
-    for order in sorted(_handlers.get(hook, {})):
-        for func in _handlers[hook][order]:
-            func(*args)
+    handlers = _flattened.get(hook)
+    if handlers:
+        if _profile is None:
+            for func in handlers:
+                func(*args)
+        else:
+            _fire_profiled(hook, handlers, args, None, False)
 
 
 # Fires a filter hook.
 def filter(hook, value, *args):
-    for order in sorted(_handlers.get(hook, {})):
-        for func in _handlers[hook][order]:
+    handlers = _flattened.get(hook)
+    if handlers:
+        if _profile is None:
+            for func in handlers:
+                value = func(value, *args)
+        else:
+            value = _fire_profiled(hook, handlers, args, value, True)
+    return value
+
+
+# Enables hook profiling.
+def enable_profiling():
+    global _profile
+    if _profile is None:
+        _profile = {'hooks': {}, 'handlers': {}}
+
+
+# Returns the profiling data recorded so far or None if profiling hasn't
+# been enabled.
+def profile():
+    return _profile
+
+
+# Fires a hook, timing the hook as a whole and each individual handler.
+def _fire_profiled(hook, handlers, args, value, is_filter):
+    hookstart = time.perf_counter()
+    for func in handlers:
+        start = time.perf_counter()
+        if is_filter:
             value = func(value, *args)
+        else:
+            func(*args)
+        _record(
+            _profile['handlers'].setdefault(hook, {}),
+            '%s.%s' % (func.__module__, func.__qualname__),
+            time.perf_counter() - start
+        )
+    _record(_profile['hooks'], hook, time.perf_counter() - hookstart)
     return value
+
+
+# Adds a timing to a [calls, total, max] entry in a profiling dictionary.
+def _record(stats, key, seconds):
+    entry = stats.get(key)
+    if entry is None:
+        stats[key] = [1, seconds, seconds]
+    else:
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+
+# Merges one [calls, total, max] entry into another.
+def _merge(entry, other):
+    entry[0] += other[0]
+    entry[1] += other[1]
+    entry[2] = max(entry[2], other[2])
+
+
+# Discard any profiling data copied from the parent process when a worker
+# process starts.
+@register('init_worker')
+def init_worker():
+    global _profile
+    if _profile is not None:
+        _profile = {'hooks': {}, 'handlers': {}}
+
+
+# Hand the profiling data recorded by a worker process back to the parent.
+@register('worker_state')
+def export_worker_profile(state):
+    global _profile
+    if _profile is not None:
+        state['profile'] = _profile
+        _profile = {'hooks': {}, 'handlers': {}}
+    return state
+
+
+# Merge the profiling data recorded by a worker process.
+@register('merge_worker_state')
+def merge_worker_profile(state):
+    if _profile is not None and 'profile' in state:
+        for hook, entry in state['profile']['hooks'].items():
+            _merge(_profile['hooks'].setdefault(hook, [0, 0.0, 0.0]), entry)
+        for hook, stats in state['profile']['handlers'].items():
+            for name, entry in stats.items():
+                target = _profile['handlers'].setdefault(hook, {})
+                _merge(target.setdefault(name, [0, 0.0, 0.0]), entry)
@@ -1,25 +1,173 @@
 # --------------------------------------------------------------------------
 # Loads and processes strings from the site's includes directory.
+#
+# Includes are exposed to templates as a lazy mapping which is shared by
+# every page in the build. The includes directory is listed when the mapping
+# is created but each include is only loaded and rendered the first time a
+# template accesses it.
+#
+# Rendered includes are cached in the .arkcache directory, keyed by the
+# digest of the include file's content, its file extension, and the record
+# fingerprint (see the ark.records module), so an unchanged include isn't
+# rendered again on the next build run.
+#
+# Includes with a .html or .htm extension, or whose names are listed in an
+# 'html_includes' variable in the site's config file, are treated as
+# pre-rendered HTML fragments and bypass the markup renderer entirely.
 # --------------------------------------------------------------------------
 
 import os
+import pickle
+import hashlib
 
 from . import utils
 from . import renderers
+from . import records
 from . import site
+from . import hooks
 
 
-# Stores rendered include strings.
+# Stores the Includes instance for the current build run.
 _includes = None
 
 
-# Returns a dictionary of rendered includes.
+# Stores rendered includes from the previous and current build runs. Each
+# cache maps a digest of an include's content and settings to html.
+_cache = { 'old': None, 'new': {} }
+
+
+# Discard any includes rendered for a previous build run in this process.
+# If the last build ran in this process its rendered includes become the
+# old cache for the next build.
+@hooks.register('init_build')
+def reset():
+    global _includes
+    _includes = None
+    if _cache['new']:
+        _cache['old'], _cache['new'] = _cache['new'], {}
+
+
+# Returns the mapping of rendered includes.
 def includes():
     global _includes
     if _includes is None:
-        _includes = {}
-        if os.path.isdir(site.inc()):
-            for finfo in utils.srcfiles(site.inc()):
-                text, _ = utils.load(finfo.path)
-                _includes[finfo.base] = renderers.render(text, finfo.ext)
+        _includes = Includes(site.inc())
     return _includes
+
+
+# Returns the path to the include cache file.
+def cachefile():
+    return site.home('.arkcache', 'includes.pickle')
+
+
+# Loads the include cache from the last build run.
+def load():
+    _cache['old'] = {}
+    if os.path.isfile(cachefile()):
+        with open(cachefile(), 'rb') as file:
+            _cache['old'] = pickle.load(file)
+
+
+# Caches the includes rendered by the current build run to disk.
+@hooks.register('exit_build')
+def save():
+    if _cache['new'] and _cache['new'] != _cache['old']:
+        if not os.path.isdir(site.home('.arkcache')):
+            os.makedirs(site.home('.arkcache'))
+        with open(cachefile(), 'wb') as file:
+            pickle.dump(_cache['new'], file)
+
+
+# Discard any rendered includes copied from the parent process when a
+# worker process starts.
+@hooks.register('init_worker')
+def init_worker():
+    _cache['new'] = {}
+
+
+# Hand the includes rendered by a worker process back to the parent.
+@hooks.register('worker_state')
+def export_worker_includes(state):
+    state['includes'], _cache['new'] = _cache['new'], {}
+    return state
+
+
+# Merge the includes rendered by a worker process.
+@hooks.register('merge_worker_state')
+def merge_worker_includes(state):
+    _cache['new'].update(state['includes'])
+
+
+class Includes(dict):
+
+    """ A lazy mapping of include names to rendered include strings.
+
+    This is a dictionary subclass so templates and tools such as pprint
+    treat it as a plain dictionary. Only rendered includes are stored in
+    the dictionary itself; missing includes are rendered on access. The
+    instance's own attributes are private so they never shadow an include
+    name in a template engine's attribute lookup.
+
+    """
+
+    def __init__(self, dirpath):
+        super().__init__()
+        self._files = {}
+        self._fingerprint = None
+        if os.path.isdir(dirpath):
+            for finfo in utils.srcfiles(dirpath):
+                self._files[finfo.base] = finfo
+
+    def __missing__(self, name):
+        if not name in self._files:
+            raise KeyError(name)
+        html = self._render(self._files[name])
+        dict.__setitem__(self, name, html)
+        return html
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, name):
+        return name in self._files
+
+    def keys(self):
+        return self._files.keys()
+
+    def values(self):
+        return [self[name] for name in self._files]
+
+    def items(self):
+        return [(name, self[name]) for name in self._files]
+
+    def get(self, name, default=None):
+        return self[name] if name in self._files else default
+
+    # Loads and renders an include file, using the cached output if the
+    # file is unchanged.
+    def _render(self, finfo):
+        text, _ = utils.load(finfo.path)
+        if finfo.ext in ('html', 'htm'):
+            return text
+        if finfo.base in site.config('html_includes', []):
+            return text
+
+        if self._fingerprint is None:
+            self._fingerprint = records.fingerprint()
+        hash = hashlib.sha1(self._fingerprint.encode())
+        hash.update(finfo.ext.encode())
+        hash.update(text.encode('utf-8'))
+        key = hash.digest()
+
+        if _cache['old'] is None:
+            load()
+        html = _cache['new'].get(key)
+        if html is None:
+            html = _cache['old'].get(key)
+        if html is None:
+            html = renderers.render(text, finfo.ext)
+        _cache['new'][key] = html
+        return html
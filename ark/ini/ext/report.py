@@ -25,3 +25,7 @@ def print_status_report():
 
     status = "%s rendered, %s written in %.2f seconds. %.4f seconds per page."
     print(status % (txt_rendered, txt_written, time, average))
+
+    # Report the time spent compiling templates if an engine has recorded it.
+    if site.timer('compile'):
+        print("Templates compiled in %.4f seconds." % site.timer('compile'))
@@ -0,0 +1,165 @@
+# --------------------------------------------------------------------------
+# Tracks the files produced by each build run and stores rendered pages in
+# memory when the site is served live.
+#
+# Every page and resource file produced by a build is recorded in an output
+# manifest which is cached in the .arkcache directory. At the end of each
+# build we delete any file listed in the previous build's manifest which is
+# no longer produced, e.g. the page of a deleted record. Files in the output
+# directory which weren't produced by Ark are never touched.
+#
+# In live mode (`ark serve --live`) pages are kept in an in-memory output
+# map rather than written to disk. Resource files are still copied to the
+# output directory as usual. Each entry in the map stores the page's encoded
+# content, an ETag derived from its content digest, and the time at which
+# its content last changed.
+# --------------------------------------------------------------------------
+
+import os
+import time
+import pickle
+import collections
+
+from . import site
+from . import hooks
+from . import hashes
+from . import writer
+
+
+# An Entry instance holds the content of a page rendered in live mode.
+Entry = collections.namedtuple('Entry', 'data, etag, mtime')
+
+
+# Maps output filepaths to Entry instances.
+_pages = {}
+
+
+# Stores the output manifests from the previous and current build runs.
+# Each manifest is a set of filepaths relative to the output directory.
+_manifest = { 'old': set(), 'new': set(), 'out': None }
+
+
+# Stores the entries created by a worker process for handing back to the
+# parent process. This is None outside of worker processes.
+_exported = None
+
+
+# Records a file and its siblings, e.g. precompressed copies, as produced
+# by the current build run.
+def produced(filepath):
+    for path in [filepath] + writer.siblings(filepath):
+        _manifest['new'].add(os.path.relpath(path, site.out()))
+
+
+# Stores a page's encoded html in the output map. Returns true if the
+# page's content has changed.
+def store(filepath, data):
+    etag = '"%s"' % hashes.digest(data).hex()
+    entry = _pages.get(filepath)
+    if entry and entry.etag == etag:
+        return False
+    _pages[filepath] = Entry(data, etag, time.time())
+    if _exported is not None:
+        _exported[filepath] = _pages[filepath]
+    return True
+
+
+# Returns the Entry instance for the specified output filepath or None if
+# the page isn't in the output map.
+def get(filepath):
+    return _pages.get(filepath)
+
+
+# Returns true if an output file exists, in memory in live mode or on disk
+# along with its siblings otherwise. Files never exist in advance when
+# building into an archive.
+def exists(filepath):
+    if site.live():
+        return filepath in _pages
+    if site.archive():
+        return False
+    for path in [filepath] + writer.siblings(filepath):
+        if not os.path.isfile(path):
+            return False
+    return True
+
+
+# Loads the output manifest from the last build run. If the last build ran
+# in this process its manifest has already been carried over by prune().
+@hooks.register('init_build')
+def load():
+    if _manifest['out'] is None:
+        path = site.home('.arkcache', 'output.pickle')
+        if os.path.isfile(path):
+            with open(path, 'rb') as file:
+                data = pickle.load(file)
+            if data['out'] == site.out():
+                _manifest['old'] = data['files']
+    _manifest['new'] = set()
+    _manifest['out'] = site.out()
+
+
+# Deletes stale output files at the end of the build and caches the output
+# manifest for the next build run. This runs after every other handler on
+# the 'exit_build' hook so tag indexes, etc. have been rendered. In live
+# mode we prune the in-memory output map instead. Nothing is pruned when
+# building into an archive.
+@hooks.register('exit_build', 100)
+def prune():
+    if site.archive():
+        return
+
+    stale = _manifest['old'] - _manifest['new']
+    _manifest['old'] = _manifest['new']
+
+    if site.live():
+        for relpath in stale:
+            _pages.pop(os.path.join(site.out(), relpath), None)
+        return
+
+    dirpaths = set()
+    for relpath in stale:
+        path = os.path.join(site.out(), relpath)
+        if os.path.isfile(path):
+            os.remove(path)
+            dirpaths.add(os.path.dirname(path))
+
+    # Remove any directories left empty, deepest first.
+    for dirpath in sorted(dirpaths, key=len, reverse=True):
+        while dirpath != site.out() and dirpath.startswith(site.out()):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                break
+            dirpath = os.path.dirname(dirpath)
+
+    if not os.path.isdir(site.home('.arkcache')):
+        os.makedirs(site.home('.arkcache'))
+    with open(site.home('.arkcache', 'output.pickle'), 'wb') as file:
+        pickle.dump({'out': site.out(), 'files': _manifest['new']}, file)
+
+
+# Start recording the entries created by a worker process.
+@hooks.register('init_worker')
+def init_worker():
+    global _exported
+    _exported = {}
+    _manifest['new'] = set()
+
+
+# Hand the entries and manifest created by a worker process back to the
+# parent.
+@hooks.register('worker_state')
+def export_worker_output(state):
+    state['output'] = (dict(_exported), _manifest['new'])
+    _exported.clear()
+    _manifest['new'] = set()
+    return state
+
+
+# Merge the entries and manifest created by a worker process.
+@hooks.register('merge_worker_state')
+def merge_worker_output(state):
+    pages, manifest = state['output']
+    _pages.update(pages)
+    _manifest['new'].update(manifest)
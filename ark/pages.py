@@ -6,13 +6,17 @@ import os
 import re
 import sys
 import math
+import time
 
 from . import site
 from . import hooks
-from . import utils
 from . import templates
 from . import includes
 from . import hashes
+from . import deps
+from . import output
+from . import writer
+from . import stats
 
 
 # A Page instance represents a single HTML page in the site's output.
@@ -24,8 +28,7 @@ class Page(dict):
     def __init__(self, rectype):
         self['flags'] = site.flags()
         self['site'] = site.config()
-        self['inc'] = includes.includes()
-        self['includes'] = includes.includes()
+        self['inc'] = self['includes'] = includes.includes()
         self['type'] = site.typeconfig(rectype)
         self['slugs'] = []
         self['record'] = None
@@ -46,6 +49,7 @@ class Page(dict):
 
     # Renders the page into HTML and prints the output file.
     def render(self):
+        start = time.perf_counter()
 
         # Fire the 'render_page' event.
         hooks.event('render_page', self)
@@ -58,21 +62,50 @@ class Page(dict):
 
         # Determine the output filepath.
         self['path'], depth = self._get_output_filepath()
+        output.produced(self['path'])
+
+        # Skip rendering the page if its inputs haven't changed since the
+        # last build run. (This only applies to incremental builds.)
+        if deps.unchanged(self):
+            if not site.live():
+                hashes.keep(self['path'])
+            return
 
         # Render the page into html.
-        html = templates.render(self)
+        with stats.timed('render_templates'):
+            html = templates.render(self)
         site.rendered(1)
 
         # Filter the page's html before writing it to disk.
         html = hooks.filter('page_html', html, self)
 
         # Rewrite all '@root/' urls into their final form.
-        html = self._rewrite_urls(html, depth)
+        with stats.timed('rewrite_urls'):
+            html = self._rewrite_urls(html, depth)
+
+        # Encode the page once for hashing and writing.
+        data = html.encode('utf-8')
 
-        # Write the page to disk. Avoid overwriting identical existing files.
-        if not hashes.match(self['path'], html):
-            utils.writefile(self['path'], html)
-            site.written(1)
+        # In live mode the page is kept in memory rather than written to disk.
+        if site.live():
+            if output.store(self['path'], data):
+                site.written(1)
+
+        # Write the page to disk or to the build's archive. Avoid overwriting
+        # identical existing files.
+        else:
+            unchanged = False
+            if not site.archive():
+                with stats.timed('hashing'):
+                    unchanged = hashes.match(self['path'], data)
+                    unchanged = unchanged and output.exists(self['path'])
+            if not unchanged:
+                with stats.timed('writing'):
+                    writer.write(self['path'], data)
+                site.written(1)
+
+        path = os.path.relpath(self['path'], site.out())
+        stats.record('pages', path, time.perf_counter() - start)
 
     # Determines the output filepath for the page.
     def _get_output_filepath(self):
@@ -116,36 +149,7 @@ class Page(dict):
         and '@root//' in an identical manner.
 
         """
-
-        def rewrite_callback(match):
-            quote = match.group(1) if match.group(1) in ('"', "'") else ''
-            url = match.group(2).lstrip('/')
-            if url == '':
-                url = 'index//'
-            fragment = match.group(3) or ''
-            prefix = site.config('root', '') or '../' * (depth - 1)
-
-            if url.endswith('//'):
-                url = url.rstrip('/')
-                ext = site.config('extension')
-                if ext == '/':
-                    if url == 'index':
-                        if depth == 1:
-                            url = '' if fragment else '#'
-                        else:
-                            url = prefix
-                    elif url.endswith('/index'):
-                        url = prefix + url[:-5]
-                    else:
-                        url = prefix + url + '/'
-                else:
-                    url = prefix + url + ext
-            else:
-                url = prefix + url
-
-            return '%s%s%s%s' % (quote, url, fragment, quote)
-
-        return self.re_url.sub(rewrite_callback, html)
+        return rewriter(depth).rewrite(html)
 
     # Generates a list of CSS classes for the page.
     def _get_class_list(self):
@@ -189,6 +193,75 @@ class Page(dict):
         return hooks.filter('page_templates', templates, self)
 
 
+# Stores UrlRewriter instances indexed by page depth.
+_rewriters = {}
+
+
+# Returns the UrlRewriter instance for pages at the specified depth.
+def rewriter(depth):
+    if not depth in _rewriters:
+        _rewriters[depth] = UrlRewriter(depth)
+    return _rewriters[depth]
+
+
+# Discard cached rewriters at the start of each build as the site's url
+# settings may have changed.
+@hooks.register('init_build')
+def clear_rewriters():
+    _rewriters.clear()
+
+
+# A UrlRewriter rewrites @root/ urls for pages at a particular depth in the
+# output directory. The site's url settings are read once on creation and
+# the final form of each distinct url is cached so repeated urls cost a
+# single dictionary lookup.
+class UrlRewriter:
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.ext = site.config('extension')
+        self.prefix = site.config('root', '') or '../' * (depth - 1)
+        self.cache = {}
+
+    # Rewrites all @root/ urls in the html string.
+    def rewrite(self, html):
+        return Page.re_url.sub(self.callback, html)
+
+    def callback(self, match):
+        key = match.group(0)
+        if not key in self.cache:
+            self.cache[key] = self.resolve(match)
+        return self.cache[key]
+
+    # Returns the final form of a matched url.
+    def resolve(self, match):
+        quote = match.group(1) if match.group(1) in ('"', "'") else ''
+        url = match.group(2).lstrip('/')
+        if url == '':
+            url = 'index//'
+        fragment = match.group(3) or ''
+        prefix = self.prefix
+
+        if url.endswith('//'):
+            url = url.rstrip('/')
+            if self.ext == '/':
+                if url == 'index':
+                    if self.depth == 1:
+                        url = '' if fragment else '#'
+                    else:
+                        url = prefix
+                elif url.endswith('/index'):
+                    url = prefix + url[:-5]
+                else:
+                    url = prefix + url + '/'
+            else:
+                url = prefix + url + self.ext
+        else:
+            url = prefix + url
+
+        return '%s%s%s%s' % (quote, url, fragment, quote)
+
+
 # A RecordPage represents a single-record page.
 class RecordPage(Page):
 
@@ -200,7 +273,9 @@ class RecordPage(Page):
         self['is_homepage'] = (record['slugs'] == ['index'])
 
 
-# An Index represents a collection of index pages.
+# An Index represents a collection of index pages. Pages are created one at
+# a time as the index is rendered so only a single page object is held in
+# memory at any time.
 class Index:
 
     def __init__(self, rectype, slugs, records, recs_per_page):
@@ -215,38 +290,63 @@ class Index:
         recs_per_page = recs_per_page or len(records) or 1
         total_pages = math.ceil(float(len(records)) / recs_per_page)
 
-        # Create the individual pages.
-        self.pages = []
-        for i in range(1, total_pages + 1):
-            page = Page(rectype)
-
-            page['records'] = records[recs_per_page * (i - 1):recs_per_page * i]
-            page['is_index'] = True
-            page['is_paged'] = (total_pages > 1)
-            page['page'] = i
-            page['total'] = total_pages
-
-            page['first_url'] = site.paged_url(slugs, 1, total_pages)
-            page['prev_url'] = site.paged_url(slugs, i - 1, total_pages)
-            page['url'] = site.paged_url(slugs, i, total_pages)
-            page['next_url'] = site.paged_url(slugs, i + 1, total_pages)
-            page['last_url'] = site.paged_url(slugs, total_pages, total_pages)
-
-            page['slugs'] = slugs[:]
-            if i == 1:
-                page['slugs'].append('index')
-            else:
-                page['slugs'].append('page-%s' % i)
-
-            page['is_homepage_index'] = (len(page['slugs']) == 1)
-            page['is_homepage'] = (page['slugs'] == ['index'])
-
-            self.pages.append(page)
+        self.rectype = rectype
+        self.slugs = slugs
+        self.records = records
+        self.recs_per_page = recs_per_page
+        self.total_pages = total_pages
+        self.attributes = {}
+        self._pages = None
 
     def __setitem__(self, key, value):
-        for page in self.pages:
+        self.attributes[key] = value
+        for page in self._pages or []:
             page[key] = value
 
+    # The list of index pages. The list is only created if it's accessed,
+    # otherwise each page is created as it's rendered so only a single page
+    # is held in memory at a time.
+    @property
+    def pages(self):
+        if self._pages is None:
+            self._pages = [self.page(i) for i in range(1, self.total_pages + 1)]
+        return self._pages
+
+    # Creates the index page with the specified page number.
+    def page(self, i):
+        slugs, total_pages = self.slugs, self.total_pages
+        recs_per_page = self.recs_per_page
+
+        page = Page(self.rectype)
+
+        page['records'] = self.records[recs_per_page * (i - 1):recs_per_page * i]
+        page['is_index'] = True
+        page['is_paged'] = (total_pages > 1)
+        page['page'] = i
+        page['total'] = total_pages
+
+        page['first_url'] = site.paged_url(slugs, 1, total_pages)
+        page['prev_url'] = site.paged_url(slugs, i - 1, total_pages)
+        page['url'] = site.paged_url(slugs, i, total_pages)
+        page['next_url'] = site.paged_url(slugs, i + 1, total_pages)
+        page['last_url'] = site.paged_url(slugs, total_pages, total_pages)
+
+        page['slugs'] = slugs[:]
+        if i == 1:
+            page['slugs'].append('index')
+        else:
+            page['slugs'].append('page-%s' % i)
+
+        page['is_homepage_index'] = (len(page['slugs']) == 1)
+        page['is_homepage'] = (page['slugs'] == ['index'])
+
+        page.update(self.attributes)
+        return page
+
     def render(self):
-        for page in self.pages:
-            page.render()
+        if self._pages is not None:
+            for page in self._pages:
+                page.render()
+        else:
+            for i in range(1, self.total_pages + 1):
+                self.page(i).render()
@@ -1,21 +1,62 @@
 # --------------------------------------------------------------------------
 # Handles the creation and caching of Record objects.
+#
+# Parsed records are also cached to disk between build runs. A record is
+# reloaded from the disk cache if its source file is unchanged, i.e. if it
+# has the same size and modification time or, failing that, the same
+# content digest. The entire cache is discarded if the code or settings
+# used to parse records have changed since the last build.
+#
+# Note that the cache stores each record as it stood before the
+# 'init_record' event fired. This event fires for every record on every
+# build, but the 'record_text' and 'record_html' filters only run when a
+# record is actually parsed.
+#
+# Records are created in chunks (see record_many() below) so the record
+# hooks don't run one record at a time. Within a chunk the 'record_text'
+# filter runs for every record, then the records are rendered, then the
+# 'record_html' filter runs for every record, then the 'init_record' event
+# fires for every record in file order. Handlers shouldn't carry state from
+# one of these hooks to the next for the same record.
+#
+# In low-memory mode only a record's header is read when the chunk is
+# created. Each record's text is then loaded, filtered, rendered, and
+# written to disk one record at a time, so the 'record_text' and
+# 'record_html' filters run back to back for each record. The stored text
+# and html are replaced by Body placeholders and loaded again on access via
+# a bounded LRU cache so only metadata is kept in memory for every record.
 # --------------------------------------------------------------------------
 
 import os
 import re
 import datetime
+import hashlib
+import pickle
+import collections
+import time
 
 from . import utils
 from . import site
 from . import hooks
 from . import renderers
+from . import extensions
+from . import meta
+from . import stats
 
 
 # Stores an in-memory cache of record objects.
 _cache = {}
 
 
+# Stores cache entries loaded from disk and entries for the current build.
+# Entries map source filepaths to (stamp, data) tuples.
+_entries = { 'old': {}, 'new': {} }
+
+
+# Stores an LRU cache of record bodies loaded from disk in low-memory mode.
+_bodies = collections.OrderedDict()
+
+
 # Returns the Record object corresponding to the specified source file.
 def record(filepath):
     if not filepath in _cache:
@@ -23,23 +64,370 @@ def record(filepath):
     return _cache[filepath]
 
 
+# Returns a list of the Record objects corresponding to a batch of source
+# files. Records which need to be rendered are grouped by file extension and
+# rendered using a single call to the extension's renderer. Records are then
+# finished in order so the 'init_record' event fires in the same order as
+# if the records had been created one at a time.
+def record_many(filepaths):
+    created, groups = {}, collections.defaultdict(list)
+    for filepath in filepaths:
+        if not filepath in _cache and not filepath in created:
+            record = Record(filepath, deferred=True)
+            if record._state[1] is not None:
+                if site.lowmem():
+                    record._render_text()
+                else:
+                    groups[record['ext']].append(record)
+            created[filepath] = record
+
+    for ext, reclist in groups.items():
+        start = time.perf_counter()
+        with stats.timed('render_markup'):
+            output = renderers.render_many([r['text'] for r in reclist], ext)
+        seconds = (time.perf_counter() - start) / len(reclist)
+        for record, html in zip(reclist, output):
+            record._render(html, seconds)
+
+    for filepath, record in created.items():
+        record._finish()
+        _cache[filepath] = record
+
+    return [_cache[filepath] for filepath in filepaths]
+
+
+# Adds a Record object created elsewhere, e.g. in a worker process, to the
+# cache.
+def add(record):
+    _cache[record['src']] = record
+
+
+# Returns a fingerprint of the code and settings used to parse records.
+# A change to the fingerprint invalidates every cached record.
+def fingerprint():
+    hash = hashlib.sha1(meta.__version__.encode())
+
+    for name, module in sorted(extensions.loaded().items()):
+        hash.update(name.encode())
+        path = getattr(module, '__file__', None)
+        if path and os.path.isfile(path):
+            hash.update(str(os.stat(path).st_mtime_ns).encode())
+
+    if os.path.isfile(site.home('config.py')):
+        with open(site.home('config.py'), 'rb') as file:
+            hash.update(file.read())
+
+    hash.update(repr(site.flags()).encode())
+    hash.update(repr(site.lowmem()).encode())
+    return hash.hexdigest()
+
+
+# Returns the content digest of the specified file. The file is read in
+# chunks so large files are never held in memory in full.
+def digest(filepath):
+    hash = hashlib.sha1()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+# Returns a (mtime, size, digest) stamp for the specified file. If the
+# file's size and mtime match those of `stamp` we reuse its digest,
+# otherwise the file is read and hashed.
+def stamp(filepath, stamp=None):
+    stat = os.stat(filepath)
+    if stamp and stamp[:2] == (stat.st_mtime_ns, stat.st_size):
+        return stamp
+    return (stat.st_mtime_ns, stat.st_size, digest(filepath))
+
+
+# Returns the content digest of a record's source file as recorded during
+# the current build run.
+def srcdigest(filepath):
+    entry = _entries['new'].get(filepath)
+    return entry[0][2] if entry else digest(filepath)
+
+
+# Stores the fingerprint of the current build run.
+_fingerprint = None
+
+
+# Loads the record cache from the last build run. If the last build ran in
+# this process, e.g. when watching the site for changes, we reuse its cache
+# entries directly. Record objects are always recreated so each build sees
+# fresh data and fires the 'init_record' event.
+@hooks.register('init_build')
+def load():
+    global _fingerprint
+    _cache.clear()
+    current = fingerprint()
+    if _entries['new']:
+        old = _entries['new'] if current == _fingerprint else {}
+        _entries['old'], _entries['new'] = old, {}
+    else:
+        path = site.home('.arkcache', 'records.pickle')
+        if os.path.isfile(path):
+            with open(path, 'rb') as file:
+                data = pickle.load(file)
+            if data.get('fingerprint') == current:
+                _entries['old'] = data['records']
+    _fingerprint = current
+
+
+# Caches records to disk for the next build run. Records containing
+# values which cannot be pickled are simply not cached.
+@hooks.register('exit_build')
+def save():
+    prune()
+    if _entries['new']:
+        try:
+            data = pickle.dumps({
+                'fingerprint': _fingerprint,
+                'records': _entries['new'],
+            })
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        if not os.path.isdir(site.home('.arkcache')):
+            os.makedirs(site.home('.arkcache'))
+        with open(site.home('.arkcache', 'records.pickle'), 'wb') as file:
+            file.write(data)
+
+
+# Deletes body files left behind by records which have been deleted or
+# renamed, or by a previous low-memory build run.
+def prune():
+    dirpath = site.home('.arkcache', 'bodies')
+    if not os.path.isdir(dirpath):
+        return
+    live = set()
+    if site.lowmem():
+        for filepath in _entries['new']:
+            live.add(hashlib.sha1(filepath.encode()).hexdigest() + '.pickle')
+    for name in os.listdir(dirpath):
+        if not name in live:
+            try:
+                os.remove(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                pass
+
+
+# Discard any cache entries copied from the parent process when a worker
+# process starts.
+@hooks.register('init_worker')
+def init_worker():
+    _entries['new'] = {}
+
+
+# Hand the cache entries created by a worker process back to the parent.
+@hooks.register('worker_state')
+def export_worker_entries(state):
+    state['records'], _entries['new'] = _entries['new'], {}
+    return state
+
+
+# Merge the cache entries created by a worker process.
+@hooks.register('merge_worker_state')
+def merge_worker_entries(state):
+    _entries['new'].update(state['records'])
+
+
+# Returns a dictionary containing a record's text and html, loading it
+# from disk if it isn't already in the cache of recently used bodies. If
+# the body file has gone missing we parse the record's source file again.
+def loadbody(path, filepath):
+    if path in _bodies:
+        _bodies.move_to_end(path)
+        return _bodies[path]
+    try:
+        with open(path, 'rb') as file:
+            return cachebody(path, pickle.load(file))
+    except FileNotFoundError:
+        return cachebody(path, reparse(filepath, path))
+
+
+# Writes a record's text and html to a body file. Worker processes may race
+# to create the bodies directory so an existing directory isn't an error.
+def writebody(path, body):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        pickle.dump(body, file)
+
+
+# Parses and renders a record's source file again, bypassing the record
+# cache, and rewrites its body file. Returns the record's text and html.
+def reparse(filepath, path):
+    record = Record.__new__(Record)
+    record._parse(filepath)
+    html = renderers.render(record['text'], record['ext'])
+    body = {
+        'text': record['text'],
+        'html': hooks.filter('record_html', html, record),
+    }
+    writebody(path, body)
+    return body
+
+
+# Recreates a pickled Record object from its raw data, without resolving
+# Body placeholders or firing events.
+def restore(data):
+    record = Record.__new__(Record)
+    dict.update(record, data)
+    return record
+
+
+# Adds a body to the cache of recently used bodies, evicting the least
+# recently used body if the cache is full.
+def cachebody(path, body):
+    _bodies[path] = body
+    _bodies.move_to_end(path)
+    while len(_bodies) > site.config('lowmem_cache', 256):
+        _bodies.popitem(last=False)
+    return body
+
+
+# A Body instance stands in for a record's text or html content in
+# low-memory mode. Converting it to a string loads the content.
+class Body:
+
+    def __init__(self, path, key, src):
+        self.path = path
+        self.key = key
+        self.src = src
+
+    def __repr__(self):
+        return 'Body(path=%s, key=%s)' % (repr(self.path), repr(self.key))
+
+    def __str__(self):
+        return loadbody(self.path, self.src)[self.key]
+
+
 class Record(dict):
 
     """ A record object represents a parsed source file.
 
     Record objects should not be instantiated directly. Instead use the
-    `record()` function to take advantage of caching.
+    `record()` or `record_many()` functions to take advantage of caching.
+
+    A deferred record is left unrendered and unfinished. Its text must be
+    rendered by calling `_render()` if required, then `_finish()` must be
+    called before the record is used.
 
     """
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, deferred=False):
+
+        # Reuse the cached record data if the source file's content is
+        # unchanged, otherwise parse the file. The stamp is refreshed so a
+        # touched but unmodified file is matched on mtime next time. The
+        # state tuple holds the file's stamp and the time spent parsing it,
+        # or None if it wasn't parsed.
+        entry = _entries['old'].get(filepath)
+        start = time.perf_counter()
+        filestamp = stamp(filepath, entry[0] if entry else None)
+        if entry and filestamp[2] == entry[0][2]:
+            self.update(entry[1])
+            self._state = (filestamp, None)
+        else:
+            self._parse(filepath, site.lowmem())
+            self._state = (filestamp, time.perf_counter() - start)
+
+        if not deferred:
+            if self._state[1] is not None:
+                self._render_text()
+            self._finish()
+
+    # Renders the record's text content. In low-memory mode only the
+    # record's header is read when it's parsed; its text is loaded and
+    # filtered here so a single record's text is held in memory at a time.
+    def _render_text(self):
+        start = time.perf_counter()
+        if site.lowmem():
+            with stats.timed('parse_records'):
+                text, _ = utils.load(self['src'])
+            self._filter_text(text)
+        with stats.timed('render_markup'):
+            html = renderers.render(self['text'], self['ext'])
+        self._render(html, time.perf_counter() - start)
+
+    # Stores the record's rendered html, running the 'record_html' filter.
+    def _render(self, html, seconds):
+        start = time.perf_counter()
+
+        # Filter the record's html content.
+        with stats.timed('html_filters'):
+            self['html'] = hooks.filter('record_html', html, self)
+
+        if site.lowmem():
+            self._store_body()
+
+        seconds += self._state[1] + time.perf_counter() - start
+        stats.record('records', self['src'], seconds)
+
+    # Caches the record's data and fires the 'init_record' event.
+    def _finish(self):
+
+        # Store a copy of the record's data for the next build run.
+        _entries['new'][self['src']] = (self._state[0], self._raw())
+        del self._state
+
+        # Fire the 'init_record' event. (Tags are processed here.)
+        hooks.event('init_record', self)
+
+    # Body placeholders are loaded transparently on access. Every mapping
+    # accessor goes through __getitem__ so templates and extensions never
+    # see a placeholder. (Overriding __iter__ also makes dict(record) and
+    # **record use keys() and __getitem__ rather than the raw storage.)
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        return str(value) if isinstance(value, Body) else value
+
+    def __iter__(self):
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def copy(self):
+        return {key: self[key] for key in self}
+
+    # Pickling preserves Body placeholders so worker processes don't hand
+    # every body back to the parent.
+    def __reduce__(self):
+        return (restore, (self._raw(),))
+
+    # Returns a copy of the record's data with Body placeholders intact.
+    def _raw(self):
+        return {key: dict.__getitem__(self, key) for key in dict.keys(self)}
+
+    # Writes the record's text and html to disk and replaces them with
+    # Body placeholders.
+    def _store_body(self):
+        name = hashlib.sha1(self['src'].encode()).hexdigest() + '.pickle'
+        path = site.home('.arkcache', 'bodies', name)
+        body = {'text': self['text'], 'html': self['html']}
+        writebody(path, body)
+        cachebody(path, body)
+        self['text'] = Body(path, 'text', self['src'])
+        self['html'] = Body(path, 'html', self['src'])
+
+    # Parses the record's source file. If header_only is true only the
+    # file's header is read and the record is left without text content.
+    def _parse(self, filepath, header_only=False):
 
         # Parse the filepath.
         dirpath = os.path.dirname(filepath)
         fileinfo = utils.fileinfo(filepath)
 
         # Load the record file.
-        text, meta = utils.load(filepath)
+        start = time.perf_counter()
+        text, meta = utils.load(filepath, header_only)
         self.update(meta)
 
         # Add the default set of record attributes.
@@ -60,15 +448,13 @@ class Record(dict):
             self['date'] = datetime.datetime.fromordinal(date.toordinal())
         else:
             self['date'] = utils.get_creation_time(filepath)
+        site.timer('parse_records', time.perf_counter() - start)
 
-        # Filter the record's text content. (Shortcodes are processed here.)
-        self['text'] = hooks.filter('record_text', text, self)
+        if not header_only:
+            self._filter_text(text)
 
-        # Render the record's content into html.
-        html = renderers.render(self['text'], fileinfo.ext)
-
-        # Filter the record's html content.
-        self['html'] = hooks.filter('record_html', html, self)
-
-        # Fire the 'init_record' event. (Tags are processed here.)
-        hooks.event('init_record', self)
+    # Filters the record's text content. (Shortcodes are processed here.)
+    # The text is rendered into html by the caller.
+    def _filter_text(self, text):
+        with stats.timed('text_filters'):
+            self['text'] = hooks.filter('record_text', text, self)
@@ -16,6 +16,10 @@ _renderers = {
 }
 
 
+# Maps file extensions to their registered batch rendering-engine callbacks.
+_batch_renderers = {}
+
+
 def register(ext):
 
     """ Decorator function for registering rendering-engine callbacks.
@@ -39,9 +43,50 @@ def register(ext):
     return register_callback
 
 
+def register_batch(ext):
+
+    """ Decorator function for registering batch rendering-engine callbacks.
+
+    A batch callback should accept a list of input strings and return a
+    list containing the rendered html for each string in the same order.
+    Engines which can amortize their setup cost across texts, or render
+    texts in parallel, can register a batch callback in addition to their
+    single-text callback, e.g.
+
+        @ark.renderers.register_batch('md')
+        def callback(texts):
+            ...
+            return rendered
+
+    The builder groups records by extension and hands them to the batch
+    callback in chunks.
+
+    """
+
+    def register_callback(callback):
+        _batch_renderers[ext] = callback
+        return callback
+
+    return register_callback
+
+
 # Renders a string and returns the result.
 def render(text, ext):
     if ext in _renderers:
         return _renderers[ext](text)
+    elif ext in _batch_renderers:
+        return _batch_renderers[ext]([text])[0]
+    else:
+        sys.exit("Error: no registered renderer for the '.%s' extension." % ext)
+
+
+# Renders a list of strings with the same extension and returns a list of
+# the results. We use the extension's batch callback if one is registered,
+# otherwise we call its single-text callback for each string in turn.
+def render_many(texts, ext):
+    if ext in _batch_renderers:
+        return list(_batch_renderers[ext](texts))
+    elif ext in _renderers:
+        return [_renderers[ext](text) for text in texts]
     else:
         sys.exit("Error: no registered renderer for the '.%s' extension." % ext)
@@ -0,0 +1,204 @@
+# --------------------------------------------------------------------------
+# Copies the site's and theme's resource files to the output directory.
+#
+# A manifest of the resource files copied by each build run is cached in
+# the .arkcache directory. It maps each output file to the source file it
+# was copied from and that file's size, modification time, and content
+# digest. A resource file is only copied if:
+#
+#   * its source file has changed since it was last copied;
+#   * or its output file is missing.
+#
+# Source directories are scanned using the stat data returned by scandir()
+# and each output directory is listed once rather than checking each output
+# file individually. Files are copied using a pool of threads. (The number
+# of threads can be set via a 'copy_threads' variable in the site's config
+# file.) Where the platform and file system support it, files are cloned
+# (reflinked) or copied within the kernel using copy_file_range().
+# --------------------------------------------------------------------------
+
+import os
+import sys
+import shutil
+import hashlib
+import pickle
+import concurrent.futures
+
+from . import site
+from . import hooks
+from . import output
+from . import writer
+
+
+# The fcntl module is only available on Unix systems.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# The Linux ioctl request code for cloning a file.
+FICLONE = 0x40049409
+
+
+# Stores the resource manifest from the previous and current build runs.
+# Maps output filepaths (relative to the output directory) to tuples
+# containing the source filepath, size, mtime, and digest. Digests are only
+# computed when a file's mtime changes but its size doesn't.
+_manifest = { 'old': {}, 'new': {} }
+
+
+# Loads the resource manifest from the last build run. If the last build
+# ran in this process we reuse its manifest directly.
+@hooks.register('init_build')
+def load():
+    if _manifest['new']:
+        _manifest['old'], _manifest['new'] = _manifest['new'], {}
+    elif os.path.isfile(site.home('.arkcache', 'resources.pickle')):
+        with open(site.home('.arkcache', 'resources.pickle'), 'rb') as file:
+            _manifest['old'] = pickle.load(file)
+
+
+# Caches the resource manifest to disk for the next build run.
+@hooks.register('exit_build')
+def save():
+    if _manifest['new']:
+        if not os.path.isdir(site.home('.arkcache')):
+            os.makedirs(site.home('.arkcache'))
+        with open(site.home('.arkcache', 'resources.pickle'), 'wb') as file:
+            pickle.dump(_manifest['new'], file)
+
+
+# Copies resource files from a list of source directories to the output
+# directory. Each item in the list is a (dirpath, skiptypes) tuple; if
+# skiptypes is true, [type] directories are skipped. Where directories
+# contain files with the same relative path the last directory wins.
+def sync(srcdirs, dstdir):
+    files = {}
+    for srcdir, skiptypes in srcdirs:
+        if os.path.isdir(srcdir):
+            scan(srcdir, skiptypes, files)
+
+    # Every file is added when building into an archive.
+    if site.archive():
+        for relpath, (srcpath, stat) in sorted(files.items()):
+            writer.copy(srcpath, os.path.join(dstdir, relpath))
+        return
+
+    listings, copies = {}, []
+    for relpath, (srcpath, stat) in sorted(files.items()):
+        dstpath = os.path.join(dstdir, relpath)
+        dirpath, name = os.path.split(dstpath)
+        output.produced(dstpath)
+        if not dirpath in listings:
+            listings[dirpath] = listdir(dirpath)
+
+        stamp = (srcpath, stat.st_size, stat.st_mtime_ns)
+        entry = _manifest['old'].get(relpath)
+        names = [name] + [os.path.basename(p) for p in writer.siblings(name)]
+        exists = all(n in (listings[dirpath] or ()) for n in names)
+
+        # Unchanged since it was last copied.
+        if exists and entry and entry[:3] == stamp:
+            _manifest['new'][relpath] = entry
+            continue
+
+        # Touched but not modified, e.g. by a version control checkout. If
+        # no digest was recorded when the file was copied we compare the
+        # digest of the existing output file.
+        if exists and entry and entry[:2] == stamp[:2]:
+            hash = digest(srcpath)
+            if hash == (entry[3] or digest(dstpath)):
+                _manifest['new'][relpath] = stamp + (hash,)
+                continue
+
+        _manifest['new'][relpath] = stamp + (None,)
+        copies.append((srcpath, dstpath))
+
+    for dirpath in {os.path.dirname(dst) for src, dst in copies}:
+        if listings.get(dirpath) is None:
+            os.makedirs(dirpath, exist_ok=True)
+
+    if len(copies) > 1:
+        threads = site.config('copy_threads', 8)
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            for future in [executor.submit(copy, *c) for c in copies]:
+                future.result()
+    elif copies:
+        copy(*copies[0])
+
+
+# Adds the files in a directory tree to a dictionary mapping relative
+# filepaths to (filepath, stat) tuples.
+def scan(dirpath, skiptypes, files, reldir=''):
+    for entry in os.scandir(dirpath):
+        if skiptypes and entry.name.startswith('['):
+            continue
+        if entry.name in ('__pycache__', '.DS_Store'):
+            continue
+        relpath = os.path.join(reldir, entry.name)
+        if entry.is_file():
+            files[relpath] = (entry.path, entry.stat())
+        elif entry.is_dir():
+            scan(entry.path, skiptypes, files, relpath)
+
+
+# Returns the set of names in a directory or None if it doesn't exist.
+def listdir(dirpath):
+    try:
+        return set(os.listdir(dirpath))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+# Returns the content digest of the specified file.
+def digest(filepath):
+    hash = hashlib.sha1()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+# Copies the file src as dst, preserving its metadata. We try cloning the
+# file first, then an in-kernel copy, then fall back on a regular copy.
+# Any sibling files, e.g. precompressed copies, are written alongside.
+def copy(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if not clone(fsrc, fdst) and not copy_range(fsrc, fdst):
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copystat(src, dst)
+    for sibling in writer.siblings(dst):
+        with open(src, 'rb') as file:
+            writer.writefile(sibling, writer.compress(file.read()))
+
+
+# Attempts to clone a file. Returns true on success.
+def clone(fsrc, fdst):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        return False
+
+
+# Attempts to copy a file using copy_file_range(). Returns true on success.
+def copy_range(fsrc, fdst):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    while True:
+        try:
+            count = os.copy_file_range(
+                fsrc.fileno(), fdst.fileno(), 1024 * 1024 * 1024
+            )
+        except OSError:
+            if copied:
+                raise
+            return False
+        if count == 0:
+            return True
+        copied += count
+
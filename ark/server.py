@@ -0,0 +1,293 @@
+# --------------------------------------------------------------------------
+# A multi-threaded development server for the site's output directory.
+#
+# Each request is handled in its own thread and connections are kept alive
+# between requests. Recently served files are cached in memory in a bounded
+# LRU cache. (The cache size in megabytes can be set via a 'serve_cache'
+# variable in the site's config file.)
+#
+# Responses carry ETag and Last-Modified headers and conditional requests
+# are answered with 304 Not Modified. A page's ETag is the hash recorded for
+# it by the last build run; other files use their size and modification
+# time. If a client accepts it, a precompressed .br or .gz variant of a file
+# is served in place of the file itself.
+#
+# In live mode the server is paired with a builder which rebuilds the site
+# in the same process. Pages are served from the in-memory output map and
+# resource files from disk. Before handling a request the server waits for
+# any rebuild in progress and rebuilds first for any change the watcher has
+# detected but not yet handled, so a stale page is never served.
+# --------------------------------------------------------------------------
+
+import os
+import shutil
+import mimetypes
+import threading
+import collections
+import socketserver
+import urllib.parse
+import email.utils
+import http.server
+import posixpath
+
+from . import site
+from . import hashes
+from . import output
+
+
+# Files larger than this are streamed from disk rather than cached.
+MAX_CACHED_FILE = 1024 * 1024
+
+
+# Precompressed variants in order of preference: (encoding, extension).
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+# A File instance holds the response data for a file on disk.
+File = collections.namedtuple('File', 'path, stamp, size, etag, mtime, data')
+
+
+# Stores an LRU cache of File instances indexed by filepath.
+class FileCache:
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.files = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, stamp):
+        with self.lock:
+            file = self.files.get(path)
+            if file and file.stamp == stamp:
+                self.files.move_to_end(path)
+                return file
+
+    def add(self, file):
+        with self.lock:
+            if file.path in self.files:
+                self.nbytes -= len(self.files.pop(file.path).data)
+            self.files[file.path] = file
+            self.nbytes += len(file.data)
+            while self.nbytes > self.maxbytes and self.files:
+                self.nbytes -= len(self.files.popitem(last=False)[1].data)
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    """ Serves a directory using a thread per request. """
+
+    daemon_threads = True
+
+    def __init__(self, address, root, builder=None):
+        http.server.HTTPServer.__init__(self, address, Handler)
+        self.root = os.path.abspath(root)
+        self.builder = builder
+        self.cache = FileCache(site.config('serve_cache', 64) * 1024 * 1024)
+        self.hashfile = {}
+        self.hashstamp = None
+        self.hashlock = threading.Lock()
+
+    # Returns the hash recorded for an output file by the last build run.
+    # The server reads its own copy of the hash file, independent of the
+    # hashes module's state which a live rebuild may be updating, and
+    # rereads it if a build has run since we last read it.
+    def pagehash(self, path):
+        with self.hashlock:
+            try:
+                stamp = os.stat(hashes.path()).st_mtime_ns
+            except OSError:
+                stamp = None
+            if stamp != self.hashstamp:
+                self.hashstamp = stamp
+                try:
+                    self.hashfile = hashes.HashFile.open(
+                        hashes.path(), hashes.algorithm()
+                    )
+                except OSError:
+                    self.hashfile = {}
+            hashfile = self.hashfile
+        value = hashfile.get(os.path.relpath(path, site.out()))
+        return (value.hex() if value else None), self.hashstamp
+
+    # Returns a File instance for a page held in memory in live mode or None
+    # if the page isn't in the output map.
+    def page(self, path):
+        if self.builder:
+            entry = output.get(path)
+            if entry:
+                return File(
+                    path, None, len(entry.data),
+                    entry.etag, entry.mtime, entry.data
+                )
+
+    # Returns a File instance for the specified filepath. Small files are
+    # read into memory and cached.
+    def file(self, path, stat):
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        file = self.cache.get(path, stamp)
+        if file:
+            return file
+
+        # We can only trust the recorded hash if the hash file was written
+        # after the file itself, i.e. by the build which produced it.
+        digest, hashstamp = self.pagehash(path)
+        if digest and hashstamp and hashstamp >= stat.st_mtime_ns:
+            etag = '"%s"' % digest
+        else:
+            etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+        data = None
+        if stat.st_size <= MAX_CACHED_FILE:
+            with open(path, 'rb') as handle:
+                data = handle.read()
+
+        file = File(path, stamp, stat.st_size, etag, stat.st_mtime, data)
+        if data is not None:
+            self.cache.add(file)
+        return file
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    """ Handles GET and HEAD requests for static files. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, body):
+        if self.server.builder:
+            self.server.builder.refresh()
+
+        path = self.translate_path(self.path)
+        if path is None:
+            return self.send_error(404)
+
+        index = os.path.join(path, 'index.html')
+        if os.path.isdir(path) or self.server.page(index):
+            urlpath = urllib.parse.urlsplit(self.path)
+            if not urlpath.path.endswith('/'):
+                location = urlpath.path + '/'
+                if urlpath.query:
+                    location += '?' + urlpath.query
+                return self.redirect(location)
+            if not os.path.isfile(index) and not self.server.page(index):
+                return self.listing(path, body)
+            path = index
+
+        ctype = self.guess_type(path)
+        encoding, file = None, self.server.page(path)
+        if file is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return self.send_error(404)
+            encoding, variant = self.variant(path)
+            if variant:
+                path, stat = variant
+            file = self.server.file(path, stat)
+        etag = file.etag
+
+        if self.not_modified(etag, file.mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(file.size))
+        self.send_header('Last-Modified', self.date_time_string(file.mtime))
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+
+        if body:
+            if file.data is not None:
+                self.wfile.write(file.data)
+            else:
+                with open(file.path, 'rb') as handle:
+                    shutil.copyfileobj(handle, self.wfile)
+
+    # Sends a listing of a directory without an index page. We borrow the
+    # standard library's implementation.
+    def listing(self, path, body):
+        output = http.server.SimpleHTTPRequestHandler.list_directory(self, path)
+        if output is not None:
+            if body:
+                shutil.copyfileobj(output, self.wfile)
+            output.close()
+
+    # Returns an (encoding, (path, stat)) tuple for the preferred
+    # precompressed variant of a file accepted by the client or
+    # (None, None) if there isn't one.
+    def variant(self, path):
+        accepted = self.accepted_encodings()
+        for encoding, ext in ENCODINGS:
+            if encoding in accepted:
+                try:
+                    return encoding, (path + ext, os.stat(path + ext))
+                except OSError:
+                    continue
+        return None, None
+
+    # Returns the set of encodings listed in the Accept-Encoding header.
+    # Encodings with a quality value of zero are excluded.
+    def accepted_encodings(self):
+        accepted = set()
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = item.partition(';')
+            params = params.replace(' ', '')
+            try:
+                if params.startswith('q=') and float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+            accepted.add(name.strip().lower())
+        return accepted
+
+    # Returns true if the request's conditional headers match.
+    def not_modified(self, etag, mtime):
+        if 'If-None-Match' in self.headers:
+            tags = [
+                tag.strip().replace('W/', '', 1)
+                for tag in self.headers['If-None-Match'].split(',')
+            ]
+            return etag in tags or '*' in tags
+        if 'If-Modified-Since' in self.headers:
+            try:
+                since = email.utils.parsedate_to_datetime(
+                    self.headers['If-Modified-Since']
+                )
+            except (TypeError, ValueError, IndexError):
+                return False
+            return since is not None and int(mtime) <= since.timestamp()
+        return False
+
+    def redirect(self, location):
+        self.send_response(301)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    # Maps a URL path to a filepath in the server's root directory.
+    # Returns None if the path lies outside the root directory.
+    def translate_path(self, urlpath):
+        urlpath = urllib.parse.urlsplit(urlpath).path
+        urlpath = posixpath.normpath(urllib.parse.unquote(urlpath))
+        parts = [part for part in urlpath.split('/') if part]
+        if any(part in (os.curdir, os.pardir) or os.sep in part
+               for part in parts):
+            return None
+        return os.path.join(self.server.root, *parts)
+
+    def guess_type(self, path):
+        return mimetypes.guess_type(path)[0] or 'application/octet-stream'
@@ -162,6 +162,40 @@ def flags():
     return config('[flags]', [])
 
 
+# Returns the number of worker processes to use for building record pages.
+def jobs():
+    return config('[jobs]', 1)
+
+
+# Returns true if pages with unchanged inputs should be skipped.
+def incremental():
+    return config('[incremental]', False)
+
+
+# Returns true if record content should be kept on disk rather than in
+# memory.
+def lowmem():
+    return config('[lowmem]', False)
+
+
+# Returns true if rendered pages should be kept in memory rather than
+# written to disk.
+def live():
+    return config('[live]', False)
+
+
+# Returns the path of the archive the site is being built into, or None if
+# the site is being built into its output directory.
+def archive():
+    return config('[archive]')
+
+
+# Returns true if compressible output files should be accompanied by
+# precompressed .gz files.
+def gzip():
+    return config('[gzip]', False)
+
+
 # Returns the output slug list for the specified record type.
 def slugs(rectype, *append):
     typeslug = typeconfig(rectype, 'slug')
@@ -238,6 +272,13 @@ def written(n=0):
     return setconfig('[written]', config('[written]') + n)
 
 
+# Adds a number of seconds to the named timer and returns the new total.
+def timer(name, seconds=0.0):
+    timers = _config.setdefault('[timers]', {})
+    timers[name] = timers.get(name, 0.0) + seconds
+    return timers[name]
+
+
 # Loads and normalizes the site's configuration data.
 def load_site_config():
 
@@ -0,0 +1,171 @@
+# --------------------------------------------------------------------------
+# Records build statistics and writes a JSON build report.
+#
+# At the end of each build we write a report to .arkcache/build-report.json
+# containing:
+#
+#   * the time spent in each phase of the build;
+#   * the time spent in each shortcode's handler and compiling each template;
+#   * the slowest records to parse and the slowest pages to render;
+#   * the peak resident memory usage of the build process and, if the build
+#     used worker processes, of its workers.
+#
+# Phase times are stored on the site's named timers. Most phases are
+# exclusive but some include others, e.g. the 'tag_indexes' phase includes
+# the time spent rendering the tag index pages. Shortcode and template
+# timers are named with a 'shortcode:' or 'template:' prefix and overlap
+# the phases so they're reported separately.
+# --------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import heapq
+import json
+import datetime
+import contextlib
+
+from . import site
+from . import hooks
+from . import meta
+
+
+# The resource module is only available on Unix systems.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Stores lists of the slowest records and pages as (seconds, name) tuples.
+_slowest = { 'records': [], 'pages': [] }
+
+
+# Records the time at which the current build started.
+_started = None
+
+
+# Records whether the current build handed work to worker processes.
+_workers = False
+
+
+# Prefixes of the timers reported in their own sections, mapped to the
+# section names.
+SECTIONS = { 'shortcode:': 'shortcodes', 'template:': 'templates' }
+
+
+# Context manager which adds the time spent in its body to a named timer.
+@contextlib.contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        site.timer(name, time.perf_counter() - start)
+
+
+# Records the time taken to process an item, e.g. a record or a page. We
+# keep the slowest items in a bounded min-heap.
+def record(kind, name, seconds):
+    heap = _slowest[kind]
+    if len(heap) < site.config('report_slowest', 10):
+        heapq.heappush(heap, (seconds, name))
+    elif seconds > heap[0][0]:
+        heapq.heapreplace(heap, (seconds, name))
+
+
+# Returns the peak resident memory usage in bytes of the current process
+# or of its terminated child processes. Returns None if the resource module
+# is unavailable.
+def peak_rss(children=False):
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+
+    # OSX reports the value in bytes, Linux and BSD report kilobytes.
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+# Record the start time of the build.
+@hooks.register('init_build')
+def init():
+    global _started, _workers
+    _started = datetime.datetime.now()
+    _workers = False
+
+
+# Splits the site's timers into the build phases and the sections above.
+# The 'compile' timer is the total of the 'template:' timers.
+def timers():
+    phases = {}
+    sections = {name: {} for name in SECTIONS.values()}
+    for name, seconds in site.config('[timers]', {}).items():
+        for prefix, section in SECTIONS.items():
+            if name.startswith(prefix):
+                sections[section][name[len(prefix):]] = seconds
+                break
+        else:
+            if name != 'compile':
+                phases[name] = seconds
+    return phases, sections
+
+
+# Write the build report at the end of a build run.
+@hooks.register('exit')
+def save():
+    if _started is None:
+        return
+
+    slowest = lambda kind, key: [
+        {key: name, 'seconds': seconds}
+        for seconds, name in sorted(_slowest[kind], reverse=True)
+    ]
+
+    phases, sections = timers()
+
+    report = {
+        'version': meta.__version__,
+        'started': _started.isoformat(),
+        'runtime': site.runtime(),
+        'jobs': site.jobs(),
+        'rendered': site.rendered(),
+        'written': site.written(),
+        'phases': phases,
+        'slowest_records': slowest('records', 'src'),
+        'slowest_pages': slowest('pages', 'path'),
+        'peak_rss': peak_rss(),
+        'peak_rss_workers': peak_rss(children=True) if _workers else None,
+    }
+    report.update(sections)
+
+    if not os.path.isdir(site.home('.arkcache')):
+        os.makedirs(site.home('.arkcache'))
+    path = site.home('.arkcache', 'build-report.json')
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+
+
+# Discard any statistics copied from the parent process when a worker
+# process starts.
+@hooks.register('init_worker')
+def init_worker():
+    _slowest['records'], _slowest['pages'] = [], []
+
+
+# Hand the statistics recorded by a worker process back to the parent.
+@hooks.register('worker_state')
+def export_worker_stats(state):
+    state['slowest'] = (_slowest['records'], _slowest['pages'])
+    init_worker()
+    return state
+
+
+# Merge the statistics recorded by a worker process.
+@hooks.register('merge_worker_state')
+def merge_worker_stats(state):
+    global _workers
+    _workers = True
+    for kind, items in zip(('records', 'pages'), state['slowest']):
+        for seconds, name in items:
+            record(kind, name, seconds)
@@ -6,14 +6,20 @@ import sys
 
 from . import site
 from . import utils
+from . import hooks
 
 
 # Maps file extensions to their registered template engine callbacks.
 _callbacks = {}
 
 
-# Stores a cached list of the theme's template files.
-_templates = None
+# Maps template names to (ext, filename) tuples for the theme's templates.
+_index = None
+
+
+# Maps tuples of candidate template names to resolved (ext, filename)
+# tuples.
+_resolved = {}
 
 
 def register(ext):
@@ -29,6 +35,10 @@ def register(ext):
         ...
         return html
 
+    Template engines can precompile the theme's templates by registering
+    a handler on the 'init_templates' event hook and calling the
+    `filenames()` function to list the files for their extension.
+
     """
 
     def register_callback(callback):
@@ -38,24 +48,68 @@ def register(ext):
     return register_callback
 
 
+# Indexes the theme's template files at the start of each build. We exit
+# immediately if a template has an unrecognised extension rather than
+# waiting until a page attempts to use it.
+@hooks.register('init_build')
+def init():
+    global _index
+    _index = None
+    _resolved.clear()
+
+    for ext, filename in index().values():
+        if not ext in _callbacks:
+            sys.exit(
+                "Error: unrecognised template extension '.%s'.\n\n"
+                "  Template: %s" % (ext, filename)
+            )
+
+    # Fire the 'init_templates' event.
+    hooks.event('init_templates')
+
+
+# Returns the index of the theme's template files. If two templates share
+# a name the first one listed wins.
+def index():
+    global _index
+    if _index is None:
+        _index = {}
+        for finfo in utils.files(site.theme('templates')):
+            if not finfo.name.startswith('.'):
+                _index.setdefault(finfo.base, (finfo.ext, finfo.name))
+    return _index
+
+
+# Returns a list of the theme's template filenames with the specified
+# extension.
+def filenames(ext):
+    return [name for e, name in index().values() if e == ext]
+
+
+# Returns the (ext, filename) tuple of the first template matching one of
+# the specified names, or None if there is no match.
+def resolve(names):
+    names = tuple(names)
+    if not names in _resolved:
+        _resolved[names] = None
+        for name in names:
+            if name in index():
+                _resolved[names] = index()[name]
+                break
+    return _resolved[names]
+
+
 # Renders the supplied page object into html.
 def render(page):
 
-    # Cache a list of the theme's template files for future calls.
-    global _templates
-    if _templates is None:
-        _templates = utils.files(site.theme('templates'))
-
     # Find the first template file matching the page's template list.
-    for name in page['templates']:
-        for finfo in _templates:
-            if name == finfo.base:
-                if finfo.ext in _callbacks:
-                    return _callbacks[finfo.ext](page, finfo.name)
-                else:
-                    sys.exit(
-                        "Error: unrecognised template extension '.%s'." % finfo.ext
-                    )
+    template = resolve(page['templates'])
+    if template:
+        ext, filename = template
+        if ext in _callbacks:
+            return _callbacks[ext](page, filename)
+        else:
+            sys.exit("Error: unrecognised template extension '.%s'." % ext)
 
     # Missing template file. Print an error message and exit.
     sys.exit(
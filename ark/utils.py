@@ -8,10 +8,19 @@ import unicodedata
 import re
 import shutil
 import datetime
+import functools
+import copy
 
 import yaml
 
 
+# Use the fast libyaml-based loader if PyYaml was built with libyaml support.
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+
 # Named tuples for file and directory information.
 DirInfo = collections.namedtuple('DirInfo', 'path, name')
 FileInfo = collections.namedtuple('FileInfo', 'path, name, base, ext')
@@ -139,15 +148,20 @@ def cleardir(dirpath):
                 shutil.rmtree(path)
 
 
-# Writes a string to a file. Creates parent directories if required.
+# Writes a string or bytes to a file. Creates parent directories if
+# required.
 def writefile(path, content):
     path = os.path.abspath(path)
 
     if not os.path.isdir(os.path.dirname(path)):
         os.makedirs(os.path.dirname(path))
 
-    with open(path, 'w', encoding='utf-8') as file:
-        file.write(content)
+    if isinstance(content, bytes):
+        with open(path, 'wb') as file:
+            file.write(content)
+    else:
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
 
 
 # Creates a redirect page at the specified filepath.
@@ -167,17 +181,49 @@ def make_redirect(filepath, url):
         file.write(html)
 
 
-# Loads a source file and parses its yaml header if present.
-def load(filepath):
+# Regex for locating a yaml header at the start of a source file.
+re_header = re.compile(r"^---\n(.*?\n)[-.]{3}\n+", re.DOTALL)
+
+
+# Loads a source file and parses its yaml header if present. If header_only
+# is true we stop reading at the end of the header and return an empty
+# string in place of the file's text content.
+def load(filepath, header_only=False):
     with open(filepath, encoding='utf-8') as file:
-        text, meta = file.read(), {}
+        text = readheader(file) if header_only else file.read()
+    meta = {}
 
-    match = re.match(r"^---\n(.*?\n)[-.]{3}\n+", text, re.DOTALL)
+    # Parsed headers are shared so we copy any mutable values.
+    match = re_header.match(text)
     if match:
         text = text[match.end(0):]
-        data = yaml.load(match.group(1))
+        data = parse_header(match.group(1))
         if isinstance(data, dict):
             for key, value in data.items():
+                if isinstance(value, (list, dict, set)):
+                    value = copy.deepcopy(value)
                 meta[key.lower().replace(' ', '_').replace('-', '_')] = value
 
-    return text, meta
+    return '' if header_only else text, meta
+
+
+# Reads the lines of a yaml header from an open source file, including the
+# opening and closing delimiters. Returns an empty string if the file does
+# not begin with a header.
+def readheader(file):
+    line = file.readline()
+    if line != '---\n':
+        return ''
+    lines = [line]
+    for line in file:
+        lines.append(line)
+        if re.match(r"[-.]{3}\n", line) and len(lines) > 2:
+            return ''.join(lines)
+    return ''
+
+
+# Parses a yaml header. Identical headers are only parsed once. (The
+# returned data is shared and should be copied before being modified.)
+@functools.lru_cache(maxsize=1024)
+def parse_header(header):
+    return yaml.load(header, Loader=YamlLoader)
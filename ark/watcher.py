@@ -0,0 +1,218 @@
+# --------------------------------------------------------------------------
+# Monitors directory trees for file system changes.
+#
+# On Linux we use the kernel's inotify interface via ctypes so changes are
+# reported as they happen. On other platforms, or if inotify is unavailable,
+# we fall back to periodically polling the directory trees for changes to
+# file sizes and modification times.
+#
+# Both watcher classes implement the same interface: the wait() method
+# blocks until one or more changes are detected and returns the set of
+# changed paths. A watcher may be polled from more than one thread, e.g. by
+# the live server draining pending changes before a request.
+# --------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import errno
+import select
+import threading
+import struct
+import ctypes
+import ctypes.util
+
+
+# Returns a watcher instance for the specified directories. Paths in the
+# `exclude` list (and everything below them) are ignored.
+def watch(dirpaths, exclude=()):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(dirpaths, exclude)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(dirpaths, exclude)
+
+
+# Base class for watchers. Handles path filtering and debouncing. Each
+# subclass provides a poll(timeout) method which returns the set of paths
+# changed within `timeout` seconds; a timeout of None blocks until a change
+# is detected.
+class Watcher:
+
+    def __init__(self, dirpaths, exclude):
+        self.dirpaths = [os.path.abspath(path) for path in dirpaths]
+        self.exclude = [os.path.abspath(path) for path in exclude]
+
+    # Returns true if the path should be ignored.
+    def excluded(self, path):
+        for expath in self.exclude:
+            if path == expath or path.startswith(expath + os.sep):
+                return True
+        return False
+
+    # Blocks until changes are detected. A burst of changes, e.g. an editor
+    # writing a temporary file and renaming it, is collected into a single
+    # set.
+    def wait(self, delay=0.2):
+        changes = set()
+        while not changes:
+            changes = self.poll(None)
+        return self.settle(changes, delay)
+
+    # Adds further changes to the set until no change arrives within `delay`
+    # seconds.
+    def settle(self, changes, delay=0.2):
+        while True:
+            more = self.poll(delay)
+            if not more:
+                return changes
+            changes |= more
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+
+    """ Watches directory trees using the Linux inotify interface. """
+
+    IN_MODIFY       = 0x00000002
+    IN_ATTRIB       = 0x00000004
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_FROM   = 0x00000040
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_DELETE       = 0x00000200
+    IN_DELETE_SELF  = 0x00000400
+    IN_MOVE_SELF    = 0x00000800
+    IN_Q_OVERFLOW   = 0x00004000
+    IN_IGNORED      = 0x00008000
+    IN_ISDIR        = 0x40000000
+    IN_NONBLOCK     = 0x00000800
+    IN_CLOEXEC      = 0x00080000
+
+    mask = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    )
+
+    header = struct.Struct('iIII')
+
+    def __init__(self, dirpaths, exclude):
+        Watcher.__init__(self, dirpaths, exclude)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self.wds = {}
+        for dirpath in self.dirpaths:
+            self.add(dirpath)
+
+    # Adds watches for a directory and all its subdirectories.
+    def add(self, dirpath):
+        for path, dirnames, _ in os.walk(dirpath):
+            dirnames[:] = [
+                name for name in dirnames
+                if not self.excluded(os.path.join(path, name))
+            ]
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(path), self.mask
+            )
+            if wd < 0:
+                code = ctypes.get_errno()
+                if code == errno.ENOSPC:
+                    raise OSError(code, "inotify watch limit reached")
+                continue
+            self.wds[wd] = path
+
+    def poll(self, timeout):
+        changes = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            changes |= self.parse(data)
+            ready, _, _ = select.select([self.fd], [], [], 0)
+        return changes
+
+    # Parses a buffer of inotify events into a set of changed paths.
+    def parse(self, data):
+        changes, offset = set(), 0
+        while offset < len(data):
+            wd, mask, _, length = self.header.unpack_from(data, offset)
+            offset += self.header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            # The kernel's event queue overflowed so some changes may have
+            # been lost. Report every watched directory as changed.
+            if mask & self.IN_Q_OVERFLOW:
+                changes.update(self.dirpaths)
+                continue
+
+            if mask & self.IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+
+            dirpath = self.wds.get(wd)
+            if dirpath is None:
+                continue
+            path = os.path.join(dirpath, os.fsdecode(name)) if name else dirpath
+            if self.excluded(path):
+                continue
+
+            created = mask & (self.IN_CREATE | self.IN_MOVED_TO)
+            if created and mask & self.IN_ISDIR:
+                self.add(path)
+            changes.add(path)
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(Watcher):
+
+    """ Watches directory trees by polling for changes. """
+
+    def __init__(self, dirpaths, exclude, interval=0.5):
+        Watcher.__init__(self, dirpaths, exclude)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.snapshot = self.scan()
+
+    # Returns a dictionary mapping filepaths to (mtime, size) tuples.
+    def scan(self):
+        snapshot = {}
+        for dirpath in self.dirpaths:
+            for path, dirnames, filenames in os.walk(dirpath):
+                dirnames[:] = [
+                    name for name in dirnames
+                    if not self.excluded(os.path.join(path, name))
+                ]
+                for name in filenames:
+                    filepath = os.path.join(path, name)
+                    try:
+                        stat = os.stat(filepath)
+                    except OSError:
+                        continue
+                    snapshot[filepath] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def poll(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.lock:
+                snapshot = self.scan()
+                changes = {
+                    path for path in snapshot.keys() | self.snapshot.keys()
+                    if snapshot.get(path) != self.snapshot.get(path)
+                }
+                self.snapshot = snapshot
+            if changes or (deadline is not None and time.time() >= deadline):
+                return changes
+            time.sleep(self.interval)
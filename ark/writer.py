@@ -0,0 +1,212 @@
+# --------------------------------------------------------------------------
+# Writes output files to disk using a pool of background threads.
+#
+# Rendered pages are queued for writing and the build carries on rendering
+# while the files are written. The queue is flushed at the end of the build
+# and at the end of each batch of records processed by a worker process.
+# (The number of threads can be set via a 'write_threads' variable in the
+# site's config file.)
+#
+# Each file is written to a temporary file in the same directory which is
+# then renamed into place, so the web server never sees a partially written
+# file. We remember which directories we've already created so we only
+# check for a directory's existence once per build.
+#
+# If the build has an archive (see the ark.archives module) output files are
+# added to the archive instead. Archive writes run on a single background
+# thread and worker processes hand their output files back to the parent.
+#
+# If the build's gzip setting is enabled each compressible output file is
+# accompanied by a precompressed .gz sibling.
+# --------------------------------------------------------------------------
+
+import os
+import io
+import gzip
+import collections
+import concurrent.futures
+
+from . import site
+from . import hooks
+from . import stats
+from . import archives
+
+
+# The maximum number of queued writes. Once the queue is full we wait for
+# the oldest write to complete before queueing another.
+MAX_QUEUED = 512
+
+
+# File extensions which are worth precompressing.
+COMPRESSIBLE = (
+    '.html', '.htm', '.css', '.js', '.json', '.xml', '.svg', '.txt', '.md',
+)
+
+
+# Stores the pool of writer threads and the pid of the process it belongs
+# to. Threads don't survive a fork so worker processes create their own.
+_pool = { 'executor': None, 'pid': None }
+
+
+# Stores the futures of queued writes.
+_queue = collections.deque()
+
+
+# Stores the set of directories known to exist.
+_dirs = set()
+
+
+# Stores the archive open for the current build run.
+_archive = None
+
+
+# Stores the output files of a worker process for handing back to the
+# parent when building into an archive. This is None outside of workers.
+_exported = None
+
+
+# Returns the list of sibling files which accompany an output file.
+def siblings(path):
+    if site.gzip() and path.endswith(COMPRESSIBLE):
+        return [path + '.gz']
+    return []
+
+
+# Returns the gzip-compressed form of a bytes object. The header carries no
+# timestamp so unchanged files compress to identical bytes.
+def compress(data):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as file:
+        file.write(data)
+    return buffer.getvalue()
+
+
+# Queues bytes to be written to the specified file.
+def write(path, data):
+    if _exported is not None:
+        _exported.append((path, data))
+    else:
+        submit(store, path, data)
+
+
+# Queues a file on disk to be copied to the specified output file. This is
+# only used when building into an archive.
+def copy(srcpath, path):
+    submit(storefile, srcpath, path)
+
+
+# Queues a task on the pool of writer threads.
+def submit(func, *args):
+    if _pool['pid'] != os.getpid():
+        threads = 1 if _archive else site.config('write_threads', 4)
+        _pool['executor'] = concurrent.futures.ThreadPoolExecutor(threads)
+        _pool['pid'] = os.getpid()
+        _queue.clear()
+    while len(_queue) >= MAX_QUEUED:
+        _queue.popleft().result()
+    _queue.append(_pool['executor'].submit(func, *args))
+
+
+# Shuts down the pool of writer threads. A new pool is started on demand.
+def reset():
+    if _pool['executor'] and _pool['pid'] == os.getpid():
+        _pool['executor'].shutdown()
+    _pool['executor'] = _pool['pid'] = None
+
+
+# Stores an output file and its siblings.
+def store(path, data):
+    entries = [(path, data)]
+    for sibling in siblings(path):
+        entries.append((sibling, compress(data)))
+    for path, data in entries:
+        if _archive:
+            _archive.add(arcname(path), data)
+        else:
+            writefile(path, data)
+
+
+# Adds a file on disk and its siblings to the archive.
+def storefile(srcpath, path):
+    _archive.addfile(arcname(path), srcpath)
+    for sibling in siblings(path):
+        with open(srcpath, 'rb') as file:
+            _archive.add(arcname(sibling), compress(file.read()))
+
+
+# Returns the name of an output file within the archive.
+def arcname(path):
+    return os.path.relpath(path, site.out()).replace(os.sep, '/')
+
+
+# Writes bytes to a file atomically. Creates parent directories if required.
+def writefile(path, data):
+    dirpath, name = os.path.split(path)
+    if not dirpath in _dirs:
+        os.makedirs(dirpath, exist_ok=True)
+        _dirs.add(dirpath)
+    tmppath = os.path.join(dirpath, '.%s.tmp' % name)
+    with open(tmppath, 'wb') as file:
+        file.write(data)
+    os.replace(tmppath, path)
+
+
+# Waits for all queued writes to complete. Any error raised while writing
+# is raised here.
+def flush():
+    while _queue:
+        _queue.popleft().result()
+
+
+# Forget the directories created by a previous build run in this process
+# as they may since have been deleted. Open the build's archive if it has
+# one.
+@hooks.register('init_build')
+def init():
+    global _archive
+    _dirs.clear()
+    if site.archive():
+        _archive = archives.open(site.archive())
+        reset()
+
+
+# Flush the queue at the end of the build before stale files are pruned and
+# close the build's archive.
+@hooks.register('exit_build', 50)
+def flush_build():
+    global _archive
+    with stats.timed('writing'):
+        flush()
+        if _archive:
+            _archive.close()
+            _archive = None
+            reset()
+
+
+# Discard any writes queued by the parent process when a worker starts as
+# they belong to the parent's threads. Worker processes hand their output
+# files back to the parent when building into an archive. A worker never
+# writes to the archive object it inherits but we mustn't discard it either:
+# its finalizer would flush buffered data into the parent's archive file.
+@hooks.register('init_worker')
+def init_worker():
+    global _exported
+    _queue.clear()
+    _pool['executor'] = _pool['pid'] = None
+    _exported = [] if site.archive() else None
+
+
+# Hand the output files of a worker process back to the parent.
+@hooks.register('worker_state')
+def export_worker_files(state):
+    state['files'] = list(_exported or [])
+    if _exported:
+        _exported.clear()
+    return state
+
+
+# Queue the output files handed back by a worker process.
+@hooks.register('merge_worker_state')
+def merge_worker_files(state):
+    for path, data in state['files']:
+        write(path, data)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Benchmarks ark.utils.load() on a set of generated record files.
+#
+# Usage: python benchmarks/load.py [number-of-records] [runs]
+#
+# Reports the mean time per record when parsing yaml headers with the
+# pure-Python SafeLoader, with the loader chosen by ark.utils (libyaml's
+# CSafeLoader if PyYaml was built with it), with a warm header cache, and
+# when reading headers only.
+# --------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import tempfile
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ark import utils
+
+
+HEADER = """\
+---
+title: Record %d
+date: 2016-01-%02d
+tags: [alpha, beta, gamma]
+author: Anon
+draft: false
+---
+
+"""
+
+BODY = "Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n\n" * 20
+
+
+# Writes `count` record files to a directory and returns their paths.
+def makerecords(dirpath, count):
+    paths = []
+    for i in range(count):
+        path = os.path.join(dirpath, 'record-%04d.md' % i)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(HEADER % (i, i % 28 + 1) + BODY)
+        paths.append(path)
+    return paths
+
+
+# Returns the mean time per record in microseconds over `runs` runs.
+def bench(paths, runs, clear=True, header_only=False):
+    total = 0.0
+    for _ in range(runs):
+        if clear:
+            utils.parse_header.cache_clear()
+        start = time.perf_counter()
+        for path in paths:
+            utils.load(path, header_only)
+        total += time.perf_counter() - start
+    return total / runs / len(paths) * 1000000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        paths = makerecords(dirpath, count)
+        loader = utils.YamlLoader
+
+        utils.YamlLoader = yaml.SafeLoader
+        print("SafeLoader, cache cleared     %6.0f us/record" % bench(paths, runs))
+
+        utils.YamlLoader = loader
+        print("%-29s %6.0f us/record" % (
+            loader.__name__ + ", cache cleared", bench(paths, runs)
+        ))
+
+        bench(paths, 1)
+        print("%-29s %6.0f us/record" % (
+            loader.__name__ + ", cache warm", bench(paths, runs, False)
+        ))
+
+        print("%-29s %6.0f us/record" % (
+            loader.__name__ + ", header only", bench(paths, runs, False, True)
+        ))
+
+
+if __name__ == '__main__':
+    main()